@@ -16,7 +16,10 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from __future__ import print_function
+
 import copy
+import gzip
 import hashlib
 import json
 import optparse
@@ -25,44 +28,46 @@ import shutil
 import sys
 import tarfile
 import tempfile
+import time
 import traceback
-import urllib
 import uuid
 
-from contextlib import (closing, contextmanager)
+from contextlib import closing
 
+from builder import context
+from builder import convert
+from builder import disk
+from builder import downloader
+from builder import fsprofile
+from builder import initrd
+from builder import loopdev
+from builder import manifest
 from builder import modules
+from builder import profiler
+from builder import replay
+from builder import scratch
 from builder import util
 
-from builder.downloader import tar_ball
+from builder.modules import install_rpms
 
 import tempita
 
 # Todo allow these to be configurable??
 HASH_ROUTINE = 'md5'
 
-# The first partition starts at block 63, and that each block is 512 bytes. 
-# So partition 1 starts at byte 32256
-PART_OFFSET = 63 * 512
-
-
-@contextmanager
-def cmd_undo(undo_how):
-    try:
-        yield None
-    finally:
-        try:
-            util.subp(undo_how)
-        except:
-            pass
+# What the image itself is converted to
+FINAL_FORMAT = 'qcow2'
 
+# Found next to this file (and not in the current directory, which for
+# builds ran by buildd.py is where the build was submitted from)
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'templates')
 
-def import_module(module_name):
-    __import__(module_name)
-    return sys.modules[module_name]
+# Root sources that have already been fetched (by download config)
+ROOT_SOURCES = {}
 
 
-def run_modules(root_dir, config):
+def run_modules(root_dir, config, prof=None):
     config = copy.deepcopy(config)
     mods = config.pop('modules', None)
     if not mods:
@@ -70,20 +75,20 @@ def run_modules(root_dir, config):
     failures = []
     which_ran = []
     for real_name in mods:
-        name = real_name.strip()
-        name = name.replace('-', '_')
-        if not name:
+        if not modules.canonical_name(real_name):
             continue
         try:
             which_ran.append(real_name)
-            mod_name = "%s.%s" % (util.obj_name(modules), name)
-            mod = import_module(mod_name)
+            mod = modules.REGISTRY.get(real_name)
             functor = getattr(mod, 'modify')
             # Give the modules a copy of the config
             # and not the 'real' thing, so that
             # they can't screw it up...
             args = [real_name, root_dir, copy.deepcopy(config)]
-            functor(*args)
+            if prof:
+                prof.call(real_name, functor, *args)
+            else:
+                functor(*args)
         except:
             print("Exception in module %r:" % (real_name))
             print('-' * 60)
@@ -98,7 +103,7 @@ def fix_fstab(root_dir, fstype):
     # <file system>        <dir>        
     # <type>    <options>             <dump> <pass>
     lines = [
-        '# Generated on %s' % (util.time_rfc2822()),
+        '# Generated on %s' % (util.time_rfc2822(util.build_epoch())),
         '%s%14s%14s%14s%14s%6s' % ('LABEL=root', 
                                    '/', fstype, 'defaults', '0', '0')
     ]
@@ -109,18 +114,6 @@ def fix_fstab(root_dir, fstype):
                     "%s\n" % (contents))
 
 
-def dd_off(loop_dev, tmp_dir, block_size='32768k'):
-    tmp_fn = tempfile.mktemp(dir=tmp_dir, suffix='.raw')
-    cmd = [
-        'dd',
-        'if=%s' % (loop_dev),
-        'bs=%s' % (block_size),
-        'of=%s' % (tmp_fn),
-    ]
-    util.subp(cmd, capture=False)
-    return tmp_fn
-
-
 def hash_file(path, out_fn, routine):
     hasher = hashlib.new(routine)
 
@@ -141,23 +134,51 @@ def hash_file(path, out_fn, routine):
     util.write_file(out_fn, contents)
 
 
-def transfer_into_tarball(path, arc_name, tb):
+def transfer_into_tarball(path, arc_name, tb, epoch=None):
     fns = [arc_name]
     util.print_iterable(fns,
         header="Adding the following to your tarball %s"
                % (util.quote(tb.name)))
     print("Please wait...")
-    tb.add(path, arc_name, recursive=False)
 
+    def clamp(tarinfo):
+        # Make the entry the same no matter who built it or when
+        tarinfo.mtime = min(tarinfo.mtime, epoch)
+        tarinfo.uid = 0
+        tarinfo.gid = 0
+        tarinfo.uname = 'root'
+        tarinfo.gname = 'root'
+        return tarinfo
+
+    if epoch is None:
+        tb.add(path, arc_name, recursive=False)
+    else:
+        tb.add(path, arc_name, recursive=False, filter=clamp)
+
+
+def make_tarball(img_dir, out_fn, epoch=None):
+    fns = sorted(os.listdir(img_dir))
+    with open(out_fn, 'wb') as out_fh:
+        # The gzip header normally contains the current time...
+        with closing(gzip.GzipFile(filename='', mode='wb', fileobj=out_fh,
+                                   mtime=epoch)) as gz_fh:
+            with closing(tarfile.open(name=out_fn, mode='w',
+                                      fileobj=gz_fh)) as tar_fh:
+                for fn in fns:
+                    src_fn = util.abs_join(img_dir, fn)
+                    transfer_into_tarball(src_fn, fn, tar_fh, epoch)
 
-def make_virt_xml(kernel_fn, ram_fn, root_fn):
-    params = {
-        'name': uuid.uuid5(uuid.NAMESPACE_URL,
+
+def make_virt_xml(kernel_fn, ram_fn, root_fn, digest=None):
+    if digest:
+        # The same build manifest makes the same domain
+        name = uuid.uuid5(uuid.NAMESPACE_URL,
                           # Just a fake url to get a uuid
-                          'http://images.yahoo.com/%s/%s/%s' % 
-                          (urllib.quote(root_fn),
-                           urllib.quote(kernel_fn),
-                           urllib.quote(ram_fn))),
+                          'http://images.yahoo.com/virt/%s' % (digest))
+    else:
+        name = uuid.uuid4()
+    params = {
+        'name': name,
         # 512 MB of ram should be enough for everyone
         'memory': (512 * 1024 * 1024),
         # Add a fake basepath on, to ensure
@@ -167,64 +188,25 @@ def make_virt_xml(kernel_fn, ram_fn, root_fn):
         'initrd': "{basepath}/" + os.path.basename(ram_fn),
         'root': "{basepath}/" + os.path.basename(root_fn),
     }
-    tpl_c = util.load_file(util.abs_join('templates', 'virt.xml'))
+    tpl_c = util.load_file(os.path.join(TEMPLATE_DIR, 'virt.xml'))
     tpl = tempita.Template(tpl_c)
     return tpl.substitute(**params)
 
 
-def ec2_convert(raw_fn, out_fn, out_fmt, strip_partition, compress):
-    # Extract the ramdisk/kernel
-    devname = create_loopback(raw_fn, PART_OFFSET)
+def ec2_convert(ctx, boot_fns):
+    (k_fn, rd_fn) = boot_fns
+    options = ctx.options
+    raw_fn = ctx.raw_fn
+    img_dir = ctx.img_dir
     with util.tempdir() as tdir:
-        img_dir = os.path.join(tdir, 'img')
-        root_dir = os.path.join(tdir, 'mnt')
-        util.ensure_dirs([img_dir, root_dir])
-        with cmd_undo(['losetup', '-d', devname]):
-            print("Copying off the ramdisk and kernel files.")
-            # Mount it
-            util.subp(['mount', devname, root_dir])
-            with cmd_undo(['umount', root_dir]):
-                # Find the right files
-                fns = {}
-                for fn in os.listdir(util.abs_join(root_dir, 'boot')):
-                    if fn.endswith('.img') and fn.startswith('initramfs-'):
-                        fns['ramdisk'] = fn
-                    if fn.startswith('vmlinuz-'):
-                        fns['kernel'] = fn
-                    if fn.startswith('initrd-') and fn.endswith('.img'):
-                        fns['base'] = fn
-                rd_fn = fns.get('ramdisk')
-                k_fn = fns.get('kernel')
-                if (not rd_fn and not k_fn) and 'base' in fns:
-                    kid = fns['base']
-                    kid = kid[0:-len('.img')]
-                    kid = kid[len('initrd-'):]
-                    cmd = ['chroot', root_dir,
-                           '/sbin/mkinitrd', '-f',
-                           os.path.join('/boot', fns['base']),
-                           kid]
-                    util.subp(cmd, capture=False)
-                    if os.path.isfile(util.abs_join(root_dir, "boot", 
-                                     "initramfs-%s.img" % (kid))):
-                        rd_fn = "initramfs-%s.img" % (kid)
-                    if os.path.isfile(util.abs_join(root_dir, "boot",
-                                      "vmlinuz-%s" % (kid))):
-                        k_fn = "vmlinuz-%s" % (kid)
-                if not rd_fn:
-                    raise RuntimeError("No initramfs-*.img file found")
-                if not k_fn:
-                    raise RuntimeError("No vmlinuz-* file found")
-                shutil.move(util.abs_join(root_dir, 'boot', rd_fn), 
-                            util.abs_join(img_dir, rd_fn))
-                shutil.move(util.abs_join(root_dir, 'boot', k_fn), 
-                            util.abs_join(img_dir, k_fn))
-            # Copy off the data (minus the partition info)
-            if strip_partition:
+        # Copy off the data (minus the partition info)
+        if options.strip_parts:
+            with ctx.attached() as devname:
                 print("Stripping off the partition table.")
                 print("Please wait...")
-                part_stripped_fn = dd_off(devname, tdir)
+                part_stripped_fn = disk.dd_off(devname, tdir)
         # Replace the orginal 'raw' file
-        if strip_partition:
+        if options.strip_parts:
             shutil.move(part_stripped_fn, raw_fn)
         # Apply some tune ups
         cmd = [
@@ -234,134 +216,199 @@ def ec2_convert(raw_fn, out_fn, out_fmt, strip_partition, compress):
             raw_fn
         ]
         util.subp(cmd, capture=False)
+        if options.shrink:
+            if options.strip_parts:
+                disk.shrink_fs(raw_fn)
+            else:
+                print("Not shrinking the filesystem since the partition"
+                      " table is not being stripped.")
         # Convert it to the final format and compress it
-        out_base_fn = os.path.basename(out_fn)
-        img_fn = out_base_fn
-        if img_fn.endswith('.tar.gz'):
-            img_fn = img_fn[0:-len('.tar.gz')]
-        img_fn += "." + out_fmt
-        img_fn = util.abs_join(img_dir, img_fn)
-        straight_convert(raw_fn, img_fn, out_fmt)
-        # Make a nice helper libvirt.xml file
-        util.write_file(util.abs_join(img_dir, 'libvirt.xml'),
-                        make_virt_xml(util.abs_join(img_dir, k_fn),
-                                      util.abs_join(img_dir, rd_fn),
-                                      util.abs_join(img_dir, img_fn)))
+        base_img_fn = util.abs_join(img_dir, convert.image_name(ctx.out_fn))
+        img_fn = base_img_fn + "." + FINAL_FORMAT
+        if options.delta_format == 'chunks':
+            # Only the changed chunks (and a manifest to delta the next
+            # build against) are kept when there is a previous build
+            convert.chunk_convert(raw_fn, base_img_fn, img_fn, FINAL_FORMAT,
+                                  options.delta_from)
+        elif options.delta_from:
+            convert.delta_convert(raw_fn, img_fn, FINAL_FORMAT,
+                                  options.delta_from)
+        else:
+            convert.straight_convert(raw_fn, img_fn, FINAL_FORMAT)
+        if options.delta_format == 'chunks' and options.delta_from:
+            # There is no image to boot, only the changed chunks of one
+            print("Not writing libvirt.xml since only a chunk delta of the"
+                  " image was written.")
+        else:
+            # Make a nice helper libvirt.xml file
+            util.write_file(util.abs_join(img_dir, 'libvirt.xml'),
+                            make_virt_xml(util.abs_join(img_dir, k_fn),
+                                          util.abs_join(img_dir, rd_fn),
+                                          util.abs_join(img_dir, img_fn),
+                                          ctx.digest))
         # Give every file written a hash/checksum file
         for fn in os.listdir(img_dir):
             src_fn = util.abs_join(img_dir, fn)
             hash_fn = src_fn + "." + HASH_ROUTINE
             hash_file(src_fn, hash_fn, HASH_ROUTINE)
         # Compress it or just move the folder around
-        if compress:
-            with closing(tarfile.open(out_fn, 'w:gz')) as tar_fh:
-                for fn in os.listdir(img_dir):
-                    src_fn = util.abs_join(img_dir, fn)
-                    transfer_into_tarball(src_fn, fn, tar_fh)
+        if options.compress:
+            make_tarball(img_dir, ctx.out_fn, util.build_epoch())
         else:
-            shutil.move(img_dir, out_fn)
-
-
-def straight_convert(raw_fn, out_fn, out_fmt):
-    cmd = ['qemu-img', 'convert', 
-           '-f', 'raw',
-           '-O', out_fmt,
-           raw_fn, out_fn]
-    util.subp(cmd, capture=False)
-
-
-def format_blank(tmp_file_name, size, fs_type):
-    print("Creating the image output file %s (scratch-version)." 
-              % (util.quote(tmp_file_name)))
-    with open(tmp_file_name, 'w+') as o_fh:
-        o_fh.truncate(0)
-        cmd = ['qemu-img', 'create', '-f', 
-               'raw', tmp_file_name, size]
-        util.subp(cmd)
-    
-    # Run fdisk on it
-    print("Creating a partition table in %s."
-          % (util.quote(tmp_file_name)))
-
-    devname = create_loopback(tmp_file_name)
-    with cmd_undo(['losetup', '-d', devname]):
-        # These are commands to fdisk that will get activated (in order)
-        fdisk_in = [
-            'n',
-            'p',
-            '1',
-            '1',
-            '',
-            'w'
-        ]
-        cmd = ['fdisk', devname]
-        util.subp(cmd, data="\n".join(fdisk_in),
-                  rcs=[0, 1])
-    
-    print("Creating a filesystem of type %s in %s." 
-          % (util.quote(fs_type), 
-             util.quote(tmp_file_name)))
-
-    devname = create_loopback(tmp_file_name, PART_OFFSET)
-
-    # Get a filesystem on it
-    with cmd_undo(['losetup', '-d', devname]):
-        cmd = ['mkfs.%s' % (fs_type), devname]
-        util.subp(cmd)
-
-
-def create_loopback(filename, offset=None):
-    cmd = ['losetup']
-    if offset:
-        cmd.extend(['-o', str(offset)])
-    cmd.extend(['--show', '-f', filename])
-    (stdout, _stderr) = util.subp(cmd)
-    devname = stdout.strip()
-    return devname
-
-
-def extract_into(tmp_file_name, fs_type, config):
+            shutil.move(img_dir, ctx.out_fn)
+
+
+def download_root(config, base_dir=None):
+    # Long running processes (see buildd.py) keep the root sources (and
+    # what they have figured out about their contents) around between builds
+    down_cfg = downloader.resolve_paths(config['download'], base_dir)
+    cache_key = json.dumps(down_cfg, sort_keys=True)
+    root_down = ROOT_SOURCES.get(cache_key)
+    if root_down is None or not root_down.is_fetched():
+        root_down = downloader.get_downloader(down_cfg)
+        root_down.fetch()
+        ROOT_SOURCES[cache_key] = root_down
+    return root_down
+
+
+def rpm_usage(rpms):
+    # Each rpm is copied into the image before being installed, and
+    # then installed (which needs its installed size), so account for both.
+    byte_am = 0
+    inode_am = 0
+    for fn in rpms:
+        rpm_size = os.path.getsize(fn)
+        try:
+            (stdout, _stderr) = util.subp(['rpm', '-qp', '--nosignature',
+                                           '--queryformat', '%{SIZE}', fn])
+            installed_size = int(stdout.strip())
+        except (util.ProcessExecutionError, ValueError):
+            # Guess that it expands to about 3x its compressed size
+            installed_size = rpm_size * 3
+        byte_am += rpm_size + installed_size
+        # Plus the copied rpm itself
+        inode_am += rpm_files(fn) + 1
+    return (byte_am, inode_am)
+
+
+def rpm_files(fn):
+    try:
+        (stdout, _stderr) = util.subp(['rpm', '-qpl', '--nosignature', fn])
+    except util.ProcessExecutionError:
+        return 0
+    files = [line for line in stdout.splitlines()
+             if line.strip() and line.strip() != '(contains no files)']
+    return len(files)
+
+
+def estimate_size(root_down, config, headroom, reserved, inode_size=256):
+    (byte_am, inode_am) = root_down.usage()
+    print("Root filesystem contents need %s bytes in %s inodes." %
+          (byte_am, inode_am))
+    rpms = install_rpms.expand_rpms(config.get('rpms'))
+    if rpms:
+        (rpm_am, rpm_inode_am) = rpm_usage(rpms)
+        print("The %s rpms to be installed need %s bytes in %s inodes."
+              % (len(rpms), rpm_am, rpm_inode_am))
+        byte_am += rpm_am
+        inode_am += rpm_inode_am
+    byte_am += inode_am * inode_size
+    byte_am = int(byte_am * (1.0 + headroom))
+    inode_am = int(inode_am * (1.0 + headroom))
+    # Leave room for the partition table and keep it megabyte rounded
+    byte_am += reserved
+    mb = 1024 * 1024
+    byte_am = ((byte_am + mb - 1) // mb) * mb
+    return (byte_am, inode_am)
+
+
+def extract_into(ctx, root_down):
+    profile = ctx.profile
     with util.tempdir() as tdir:
-        # Download the image
-        # TODO (make this a true module that can be changed...)
-        tb_down = tar_ball.TarBallDownloader(dict(config['download']))
-        arch_fn = tb_down.download()
-
         # Extract it
-        devname = create_loopback(tmp_file_name, PART_OFFSET)
-        with cmd_undo(['losetup', '-d', devname]):
+        with ctx.attached() as devname:
             # Mount it
             root_dir = os.path.join(tdir, 'mnt')
             os.makedirs(root_dir)
-            util.subp(['mount', devname, root_dir])
             # Extract it
-            with cmd_undo(['umount', root_dir]):
-                print("Extracting 'root' tarball %s to %s." % 
-                                        (util.quote(arch_fn), 
-                                         util.quote(root_dir)))
-                util.subp(['tar', '-xzf', arch_fn, '-C', root_dir])
+            with ctx.loops.mounted(devname, root_dir,
+                                   options=profile['mount']):
+                start_used = util.used_space(root_dir)
+                start = time.time()
+                root_down.populate(root_dir)
+                util.subp(['sync'])
+                fsprofile.report_extraction(ctx.config, profile,
+                                            util.used_space(root_dir) -
+                                            start_used,
+                                            time.time() - start)
                 # Fixup the fstab
-                fix_fstab(root_dir, fs_type)
+                fix_fstab(root_dir, ctx.options.fs_type)
 
 
-def activate_modules(tmp_file_name, config):
+def activate_modules(ctx):
+    compact = ctx.options.compact
+    raw_fn = ctx.raw_fn
     with util.tempdir() as tdir:
-        devname = create_loopback(tmp_file_name, PART_OFFSET)
-        with cmd_undo(['losetup', '-d', devname]):
+        with ctx.attached() as devname:
             # Mount it
             root_dir = os.path.join(tdir, 'mnt')
             os.makedirs(root_dir)
-            util.subp(['mount', devname, root_dir])
+            boot_fns = None
+            start_alloc = None
+            trimmed = False
             # Run your modules!
-            with cmd_undo(['umount', root_dir]):
-                return run_modules(root_dir, config)
-
-
-def main():
+            with ctx.loops.mounted(devname, root_dir,
+                                   options=ctx.profile['mount']):
+                (which_ran, failures) = run_modules(root_dir, ctx.config,
+                                                    ctx.prof)
+                if ctx.prof:
+                    ctx.prof.save(ctx.img_dir)
+                if failures:
+                    return (which_ran, failures, boot_fns)
+                # While its mounted grab the kernel and ramdisk
+                boot_fns = initrd.harvest_boot(root_dir, ctx.img_dir,
+                                               initrd.cache_dir(ctx.config))
+                if compact:
+                    # Measure after the modules so that only what compacting
+                    # frees up gets reported
+                    util.subp(['sync'])
+                    start_alloc = util.allocated_size(raw_fn)
+                    print("Discarding unused filesystem blocks.")
+                    trimmed = disk.trim_fs(root_dir)
+            if compact and not trimmed:
+                print("Discarding not supported, zeroing unused blocks.")
+                if not disk.zero_free(devname, raw_fn):
+                    print("Unable to compact %s, continuing anyway."
+                          % (util.quote(raw_fn)))
+            if compact:
+                print("Compacted %s from %s to %s allocated bytes." %
+                      (util.quote(raw_fn), start_alloc,
+                       util.allocated_size(raw_fn)))
+            return (which_ran, failures, boot_fns)
+
+
+def make_parser():
     parser = optparse.OptionParser()
     parser.add_option("-s", '--size', dest="size",
                       metavar="SIZE",
-                      help="image size (qemu-img understandable)")
+                      help=("image size (qemu-img understandable) or 'auto'"
+                            " to compute it from the root tarball and rpms"))
+    parser.add_option('--size-headroom', dest='size_headroom',
+                      metavar='PERCENT', type='float', default=20.0,
+                      help=("extra space to add when using an 'auto' size"
+                            " (default: %default)"))
+    parser.add_option('--shrink',
+                      dest='shrink',
+                      action='store_true',
+                      default=False,
+                      help=("shrink the filesystem to its minimum size"
+                            " before conversion (default: %default)"))
+    parser.add_option('--no-compact',
+                      dest='compact',
+                      action='store_false',
+                      default=True,
+                      help=("do not discard unused filesystem blocks"
+                            " before conversion"))
     parser.add_option("-o", '--output', dest="file_name",
                       metavar="FILE",
                       help="output filename")
@@ -389,8 +436,137 @@ def main():
                       default=True,
                       help=("strip the image partition table"
                            " (default: %default)"))
-    (options, _args) = parser.parse_args()
-    
+    parser.add_option('--align',
+                      dest='alignment',
+                      metavar='SIZE',
+                      default=str(disk.PART_ALIGNMENT),
+                      help=("alignment of the partition start, in bytes or"
+                            " with a K/M/G suffix (default: %default)"))
+    parser.add_option('--partition-table',
+                      dest='part_table',
+                      metavar='TYPE',
+                      type='choice',
+                      choices=disk.PART_TABLES,
+                      default='msdos',
+                      help=("partition table type, one of %s"
+                            " (default: %%default)"
+                            % (", ".join(disk.PART_TABLES))))
+    parser.add_option('--fs-profile',
+                      dest='fs_profile',
+                      metavar='PROFILE',
+                      type='choice',
+                      choices=sorted(fsprofile.FS_PROFILES.keys()),
+                      default='none',
+                      help=("filesystem tuning used while populating the"
+                            " image, one of %s (default: %%default)"
+                            % (", ".join(sorted(fsprofile.FS_PROFILES)))))
+    parser.add_option('--scratch-dir',
+                      dest='scratch_dir',
+                      metavar='DIR',
+                      help=("where scratch files are placed"
+                            " (default: the system temporary directory)"))
+    parser.add_option('--scratch-mode',
+                      dest='scratch_mode',
+                      metavar='MODE',
+                      type='choice',
+                      choices=scratch.MODES,
+                      default='disk',
+                      help=("how the scratch space is backed, one of %s,"
+                            " memory backed modes fall back to the disk when"
+                            " not enough memory is available"
+                            " (default: %%default)"
+                            % (", ".join(scratch.MODES))))
+    parser.add_option('--scratch-reserve',
+                      dest='scratch_reserve',
+                      metavar='SIZE',
+                      default='1G',
+                      help=("memory to leave free when using a memory"
+                            " backed scratch space (default: %default)"))
+    parser.add_option('--delta-from',
+                      dest='delta_from',
+                      metavar='FILE',
+                      help=("previous build to output a block delta against"
+                            " (its qcow2 image or, for chunk deltas, its"
+                            " chunk manifest)"))
+    parser.add_option('--delta-format',
+                      dest='delta_format',
+                      metavar='FORMAT',
+                      type='choice',
+                      choices=['qcow2', 'chunks'],
+                      default='qcow2',
+                      help=("'qcow2' for an overlay with the previous image"
+                            " as its backing file or 'chunks' for a chunk"
+                            " manifest plus the changed chunks, see"
+                            " tools/img-delta.py (default: %default)"))
+    parser.add_option('--deterministic',
+                      dest='deterministic',
+                      action='store_true',
+                      default=False,
+                      help=("clamp the fstab, output tarball and gzip header"
+                            " timestamps to SOURCE_DATE_EPOCH (or 0) and"
+                            " derive the filesystem and libvirt.xml uuids from"
+                            " the build manifest, the image contents (file"
+                            " and superblock times) still differ between"
+                            " builds (default: %default)"))
+    parser.add_option('--output-cache',
+                      dest='output_cache',
+                      metavar='DIR',
+                      help=("store outputs here by build manifest digest and"
+                            " return a stored output when a build with the"
+                            " same manifest is requested again"))
+    parser.add_option('--loop-state-dir',
+                      dest='loop_state_dir',
+                      metavar='DIR',
+                      default=loopdev.STATE_DIR,
+                      help=("where loop device and mount ownership is"
+                            " tracked (shared by all builds on a host)"
+                            " (default: %default)"))
+    parser.add_option('--max-loops',
+                      dest='max_loops',
+                      metavar='COUNT',
+                      type='int',
+                      default=loopdev.MAX_ATTACHED,
+                      help=("maximum loop devices attached at once by all"
+                            " builds on this host (default: %default)"))
+    parser.add_option('--record',
+                      dest='record',
+                      metavar='FILE',
+                      help=("record every command the build runs (with its"
+                            " output and timing) into this file"))
+    parser.add_option('--replay',
+                      dest='replay',
+                      metavar='FILE',
+                      help=("replay a recorded build instead of running its"
+                            " commands (no root needed, see also"
+                            " --loop-state-dir)"))
+    parser.add_option('--replay-speed',
+                      dest='replay_speed',
+                      metavar='FACTOR',
+                      type='float',
+                      default=1.0,
+                      help=("how much faster than recorded the commands are"
+                            " replayed, 0 for no delays (default: %default)"))
+    parser.add_option('--profile',
+                      dest='profile',
+                      action='store_true',
+                      default=False,
+                      help=("profile each module and account for the"
+                            " resources its commands use, the results are"
+                            " added to the output (default: %default)"))
+    parser.add_option('--profile-top',
+                      dest='profile_top',
+                      metavar='COUNT',
+                      type='int',
+                      default=5,
+                      help=("how many of the slowest modules and commands"
+                            " to show when profiling (default: %default)"))
+    return parser
+
+
+def main(args=None):
+    parser = make_parser()
+    (options, _args) = parser.parse_args(args)
+
     # Ensure options are ok
     if not options.size:
         parser.error("Option -s is required")
@@ -398,9 +574,62 @@ def main():
         parser.error("Option -o is required")
     if not options.config:
         parser.error("Option -c is required")
+    try:
+        options.alignment = util.parse_size(options.alignment)
+    except ValueError:
+        parser.error("Option --align must be a size")
+    if options.alignment <= 0 or options.alignment % disk.SECTOR_SIZE:
+        parser.error("Option --align must be a positive multiple of %s"
+                     % (disk.SECTOR_SIZE))
+    if (options.part_table == 'gpt' and
+            options.alignment < disk.GPT_HEAD_SECTORS * disk.SECTOR_SIZE):
+        parser.error("Option --align must be at least %s with a gpt"
+                     " partition table" % (disk.GPT_HEAD_SECTORS *
+                                           disk.SECTOR_SIZE))
+    try:
+        options.scratch_reserve = util.parse_size(options.scratch_reserve)
+    except ValueError:
+        parser.error("Option --scratch-reserve must be a size")
+    if options.record and options.replay:
+        parser.error("Options --record and --replay can not be used together")
+
+    runner = None
+    if options.record:
+        print("Recording the commands ran into %s." %
+              (util.quote(options.record)))
+        runner = replay.Recorder(options.record)
+    elif options.replay:
+        print("Replaying the commands recorded in %s." %
+              (util.quote(options.replay)))
+        runner = replay.Replayer(options.replay, options.replay_speed)
+    prof = None
+    if options.profile:
+        prof = profiler.ModuleProfiler()
+    old_runner = None
+    if runner:
+        old_runner = util.set_subp_runner(runner)
+    try:
+        result = make_image(parser, options, prof)
+    finally:
+        if runner:
+            util.set_subp_runner(old_runner)
+        if options.replay:
+            runner.report()
+    if prof:
+        prof.report(options.profile_top)
+    return result
+
 
+def make_image(parser, options, prof=None):
     full_fn = os.path.abspath(options.file_name)
-    final_format = 'qcow2'
+    if options.delta_from and options.delta_format == 'qcow2':
+        img_fn = "%s.%s" % (convert.image_name(full_fn), FINAL_FORMAT)
+        if os.path.basename(options.delta_from) == img_fn:
+            parser.error(("Option --delta-from must not have the same name"
+                          " as the new image (%s), rename the previous image"
+                          " or use a different output name") % (img_fn))
+    if options.deterministic and util.build_epoch() is None:
+        os.environ['SOURCE_DATE_EPOCH'] = '0'
 
     config = {}
     with open(options.config, 'r') as fh:
@@ -408,27 +637,82 @@ def main():
 
     print("Loaded builder config from %s:" % (util.quote(options.config)))
     print(json.dumps(config, sort_keys=True, indent=4))
-    with tempfile.NamedTemporaryFile(suffix='.raw') as tfh:
-        tmp_file_name = tfh.name
-        format_blank(tmp_file_name, options.size, options.fs_type)
-        extract_into(tmp_file_name, options.fs_type, config)
-
-        (ran, fails) = activate_modules(tmp_file_name, config)
-        if len(fails):
-            fail_am = util.quote(str(len(fails)), quote_color='red')
-        else:
-            fail_am = '0'
-        print("Ran %s modules with %s failures." % (len(ran), fail_am))
-        if len(fails):
-            print(("Not performing scratch to final image"
-                   " conversion due to %s failures!!") % (fail_am))
-            return len(fails)
-
-        print("Converting %s to final file %s." %
-              (util.quote(tmp_file_name), util.quote(full_fn)))
-        ec2_convert(tmp_file_name, full_fn, final_format,
-                    options.strip_parts, options.compress)
-        return 0
+    # Find any config mistakes now, instead of after all the slow stuff...
+    errors = modules.REGISTRY.validate(config)
+    if errors:
+        util.print_iterable(errors,
+                            header="Not building due to %s module config"
+                                   " problems" % (len(errors)))
+        return len(errors)
+    loops = loopdev.LoopManager(options.loop_state_dir, options.max_loops)
+    reaped = loops.reap()
+    if reaped:
+        print("Reaped %s stale loop devices and mounts." % (reaped))
+    root_down = download_root(config)
+    digest = None
+    if options.output_cache or util.build_epoch() is not None:
+        digest = manifest.digest(manifest.build_manifest(
+            config, options, root_down.digest(manifest.ROUTINE)))
+        print("Build manifest digest is %s." % (util.quote(digest)))
+        if options.output_cache and manifest.find_memoized(
+                options.output_cache, digest, full_fn):
+            return 0
+    size = options.size
+    inodes = None
+    if size == 'auto':
+        reserved = disk.partition_overhead(options.alignment,
+                                           options.part_table)
+        (size, inodes) = estimate_size(root_down, config,
+                                       options.size_headroom / 100.0,
+                                       reserved)
+        print("Automatically sized the image at %s bytes with %s inodes."
+              % (util.quote(size), inodes))
+        size = str(size)
+    try:
+        peak = scratch.estimate_peak(util.parse_size(size),
+                                     options.strip_parts)
+    except ValueError:
+        parser.error("Option -s must be a size or 'auto'")
+    with scratch.workspace(loops, options.scratch_dir, options.scratch_mode,
+                           peak, options.scratch_reserve):
+        with util.tempdir() as work_dir, \
+             tempfile.NamedTemporaryFile(suffix='.raw') as tfh:
+            ctx = context.BuildContext(loops, options, config, tfh.name,
+                                       work_dir)
+            ctx.prof = prof
+            result = build(ctx, root_down, size, inodes, digest)
+    if result == 0 and options.output_cache:
+        manifest.memoize(options.output_cache, digest, full_fn)
+    return result
+
+
+def build(ctx, root_down, size, inodes, digest=None):
+    fs_uuid = None
+    if digest and util.build_epoch() is not None:
+        ctx.digest = digest
+        fs_uuid = uuid.uuid5(uuid.NAMESPACE_URL,
+                             'http://images.yahoo.com/fs/%s' % (digest))
+    ctx.profile = fsprofile.get_profile(ctx.options.fs_profile,
+                                        ctx.options.fs_type)
+    ctx.part = disk.format_blank(ctx, size, inodes, fs_uuid)
+    extract_into(ctx, root_down)
+
+    (ran, fails, boot_fns) = activate_modules(ctx)
+    if fails:
+        fail_am = util.quote(str(len(fails)), quote_color='red')
+    else:
+        fail_am = '0'
+    print("Ran %s modules with %s failures." % (len(ran), fail_am))
+    if fails:
+        print(("Not performing scratch to final image"
+               " conversion due to %s failures!!") % (fail_am))
+        return len(fails)
+
+    fsprofile.restore_fs(ctx)
+    print("Converting %s to final file %s." %
+          (util.quote(ctx.raw_fn), util.quote(ctx.out_fn)))
+    ec2_convert(ctx, boot_fns)
+    return 0
 
 
 if __name__ == '__main__':
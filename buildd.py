@@ -0,0 +1,168 @@
+#!/usr/bin/python
+
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from __future__ import print_function
+
+import grp
+import json
+import optparse
+import os
+import sys
+
+from builder import daemon
+from builder import util
+
+import build
+
+
+# Build options which take a path
+PATH_OPTIONS = [
+    ('-o', '--output'),
+    (None, '--delta-from'),
+    (None, '--output-cache'),
+    (None, '--scratch-dir'),
+    (None, '--loop-state-dir'),
+    (None, '--record'),
+    (None, '--replay'),
+]
+
+
+def abs_build_args(args):
+    # The server may be running somewhere else, so make the paths absolute
+    args = list(args)
+    for (i, arg) in enumerate(args):
+        for (short_opt, long_opt) in PATH_OPTIONS:
+            if arg in (short_opt, long_opt) and i + 1 < len(args):
+                args[i + 1] = os.path.abspath(args[i + 1])
+            elif arg.startswith(long_opt + '='):
+                args[i] = '%s=%s' % (long_opt,
+                                     os.path.abspath(arg[len(long_opt) + 1:]))
+    return args
+
+
+def show(responses):
+    rc = 0
+    responses = list(responses)
+    if not responses:
+        print("Error: no response from the server")
+        return 1
+    for resp in responses:
+        if 'log' in resp:
+            sys.stdout.write(resp['log'])
+            sys.stdout.flush()
+        elif 'error' in resp:
+            print("Error: %s" % (resp['error']))
+            rc = 1
+        else:
+            print(json.dumps(resp, sort_keys=True, indent=4))
+            if resp.get('rc'):
+                rc = resp['rc']
+    return rc
+
+
+def main():
+    parser = optparse.OptionParser(usage=("%prog serve | submit [-- BUILD"
+                                          " OPTIONS] | status [JOB] |"
+                                          " logs JOB"))
+    parser.add_option('--socket',
+                      dest='socket_path',
+                      metavar='FILE',
+                      default='/var/run/image-builder/buildd.sock',
+                      help="socket the server listens on (default: %default)")
+    parser.add_option('--state-dir',
+                      dest='state_dir',
+                      metavar='DIR',
+                      default='/var/lib/image-builder',
+                      help=("where the server keeps job configs and logs"
+                            " (default: %default)"))
+    parser.add_option('--max-jobs',
+                      dest='max_jobs',
+                      metavar='COUNT',
+                      type='int',
+                      default=2,
+                      help=("how many builds the server runs at once"
+                            " (default: %default)"))
+    parser.add_option('--group',
+                      dest='group',
+                      metavar='GROUP',
+                      help=("also let the members of this group use the"
+                            " server, which lets them run builds as the"
+                            " server user (by default only that user and"
+                            " root can)"))
+    parser.add_option('-c', '--config',
+                      metavar='FILE',
+                      dest='config',
+                      default=os.path.join(os.getcwd(), "build.yaml"),
+                      help=("yaml config file to submit"
+                            " (default: %default)"))
+    parser.add_option('-f', '--follow',
+                      dest='follow',
+                      action='store_true',
+                      default=False,
+                      help=("keep streaming the log of a submitted (or"
+                            " given) job until it finishes"
+                            " (default: %default)"))
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error("An action is required")
+    action = args[0]
+    if action == 'serve':
+        if options.group:
+            try:
+                grp.getgrnam(options.group)
+            except KeyError:
+                parser.error("Unknown group %r" % (options.group))
+        util.ensure_dir(os.path.dirname(os.path.abspath(options.socket_path)))
+        server = daemon.Daemon(build, options.socket_path, options.state_dir,
+                               options.max_jobs, options.group)
+        server.serve()
+        return 0
+    elif action == 'submit':
+        resp = daemon.request(options.socket_path, {
+            'action': 'submit',
+            'config': util.load_file(options.config),
+            'args': abs_build_args(args[1:]),
+            # Relative paths in the config are relative to here
+            'cwd': os.getcwd(),
+        })
+        resp = list(resp)
+        rc = show(resp)
+        if rc or not options.follow:
+            return rc
+        return show(daemon.request(options.socket_path, {
+            'action': 'logs',
+            'job': resp[0]['job'],
+            'follow': True,
+        }))
+    elif action == 'status':
+        req = {'action': 'status'}
+        if len(args) > 1:
+            req['job'] = args[1]
+        return show(daemon.request(options.socket_path, req))
+    elif action == 'logs' and len(args) == 2:
+        return show(daemon.request(options.socket_path, {
+            'action': 'logs',
+            'job': args[1],
+            'follow': options.follow,
+        }))
+    parser.error("Unknown action or wrong arguments")
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,43 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+
+
+class BuildContext(object):
+    # What the stages of a single build share (instead of each stage being
+    # passed each of these on its own)
+    def __init__(self, loops, options, config, raw_fn, work_dir):
+        self.loops = loops
+        self.options = options
+        self.config = config
+        # The scratch raw image
+        self.raw_fn = raw_fn
+        # Where the files that make up the output are gathered
+        self.img_dir = os.path.join(work_dir, 'img')
+        self.out_fn = os.path.abspath(options.file_name)
+        # The (offset, size) of the partition, once it has been made (until
+        # then the whole raw image is attached)
+        self.part = ()
+        # The filesystem build profile (see builder.fsprofile)
+        self.profile = None
+        # The module profiler (see builder.profiler), when profiling
+        self.prof = None
+        # The build manifest digest, when the build is deterministic
+        self.digest = None
+
+    def attached(self):
+        return self.loops.attached(self.raw_fn, *self.part)
@@ -0,0 +1,95 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# Converts the raw image into its final format, either whole or as a block
+# delta against a previous build (see builder.delta).
+
+from __future__ import print_function
+
+import json
+import os
+
+from builder import delta
+from builder import util
+
+
+def image_name(out_fn):
+    # The name (without the format extension) of the image in the output
+    img_fn = os.path.basename(out_fn)
+    if img_fn.endswith('.tar.gz'):
+        img_fn = img_fn[0:-len('.tar.gz')]
+    return img_fn
+
+
+def image_format(img_fn):
+    (stdout, _stderr) = util.subp(['qemu-img', 'info', '--output=json',
+                                   img_fn])
+    return json.loads(stdout)['format']
+
+
+def straight_convert(raw_fn, out_fn, out_fmt):
+    cmd = ['qemu-img', 'convert',
+           '-f', 'raw',
+           '-O', out_fmt,
+           raw_fn, out_fn]
+    util.subp(cmd, capture=False)
+
+
+def delta_convert(raw_fn, out_fn, out_fmt, backing_fn):
+    # Only store the clusters that differ from the previous image
+    backing_fn = os.path.abspath(backing_fn)
+    if os.path.basename(backing_fn) == os.path.basename(out_fn):
+        # It would end up being its own backing file
+        raise ValueError("Overlay %s can not have a backing file with the"
+                         " same name" % (os.path.basename(out_fn)))
+    # Newer qemu-img refuses to guess the format of the backing file
+    backing_fmt = image_format(backing_fn)
+    print("Converting %s as an overlay of %s (a %s image)." %
+          (util.quote(raw_fn), util.quote(backing_fn),
+           util.quote(backing_fmt)))
+    cmd = ['qemu-img', 'convert',
+           '-f', 'raw',
+           '-O', out_fmt,
+           '-B', backing_fn,
+           '-F', backing_fmt,
+           raw_fn, out_fn]
+    util.subp(cmd, capture=False)
+    # Make the backing file relative so it can be found when the previous
+    # image is placed next to this one (wherever that ends up being).
+    cmd = ['qemu-img', 'rebase', '-u',
+           '-b', os.path.basename(backing_fn),
+           '-F', backing_fmt,
+           out_fn]
+    util.subp(cmd, capture=False)
+
+
+def chunk_convert(raw_fn, base_fn, img_fn, out_fmt, manifest_fn):
+    new_manifest_fn = base_fn + '.manifest'
+    if not manifest_fn:
+        straight_convert(raw_fn, img_fn, out_fmt)
+        print("Writing chunk manifest %s." % (util.quote(new_manifest_fn)))
+        delta.write_manifest(delta.make_manifest(raw_fn), new_manifest_fn)
+        return
+    delta_fn = base_fn + '.delta'
+    print("Writing the chunks of %s that changed since %s to %s." %
+          (util.quote(raw_fn), util.quote(manifest_fn),
+           util.quote(delta_fn)))
+    (manifest, changed) = delta.make_delta(raw_fn,
+                                           delta.load_manifest(manifest_fn),
+                                           delta_fn)
+    delta.write_manifest(manifest, new_manifest_fn)
+    print("%s of %s chunks changed." % (len(changed),
+                                        len(manifest['chunks'])))
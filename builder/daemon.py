@@ -0,0 +1,335 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# A long running build server, jobs (a build config + build options) are
+# submitted over a local UNIX socket using one json request per connection:
+#
+#   {"action": "submit", "config": "<yaml>", "args": ["-s", "4G", ...],
+#    "cwd": "<dir relative paths are relative to>"}
+#   {"action": "status", "job": "<id>"}  (or without a job for all of them)
+#   {"action": "logs", "job": "<id>", "follow": true}
+#
+# Each response is one or more json lines. Builds run in forked children so
+# that they start with everything already imported and with the root sources
+# the server has already fetched (and scanned) still in memory.
+
+from __future__ import print_function
+
+import Queue
+import SocketServer
+import grp
+import json
+import os
+import pwd
+import socket
+import struct
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+from builder import modules
+from builder import util
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+FINISHED_STATES = [DONE, FAILED]
+
+# Gives the (pid, uid, gid) of the process on the other end of a UNIX socket
+# (python 2 does not have the linux constant)
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+PEERCRED = struct.Struct('3i')
+
+
+def peer_uid(sock):
+    creds = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, PEERCRED.size)
+    (_pid, uid, _gid) = PEERCRED.unpack(creds)
+    return uid
+
+
+class Job(object):
+    def __init__(self, job_dir, config_blob, args, cwd=None):
+        self.job_id = uuid.uuid4().hex[0:12]
+        self.dir = os.path.join(job_dir, self.job_id)
+        self.config_fn = os.path.join(self.dir, 'build.yaml')
+        self.log_fn = os.path.join(self.dir, 'build.log')
+        self.args = list(args)
+        self.cwd = cwd
+        self.state = QUEUED
+        self.exit_code = None
+        self.submitted_on = time.time()
+        self.started_on = None
+        self.finished_on = None
+        util.write_file(self.config_fn, config_blob)
+        util.ensure_file(self.log_fn)
+
+    @property
+    def finished(self):
+        return self.state in FINISHED_STATES
+
+    def to_dict(self):
+        return {
+            'job': self.job_id,
+            'state': self.state,
+            'rc': self.exit_code,
+            'args': self.args,
+            'cwd': self.cwd,
+            'submitted_on': self.submitted_on,
+            'started_on': self.started_on,
+            'finished_on': self.finished_on,
+        }
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def _send(self, data):
+        self.wfile.write("%s\n" % (json.dumps(data)))
+        self.wfile.flush()
+
+    def handle(self):
+        try:
+            uid = peer_uid(self.request)
+            if not self.server.daemon.allowed(uid):
+                self._send({'error': "User %s is not allowed to use this"
+                                     " server" % (uid)})
+                return
+            req = json.loads(self.rfile.readline())
+            action = req.get('action')
+            if action == 'submit':
+                job = self.server.daemon.submit(req.get('config') or '',
+                                                req.get('args') or [],
+                                                req.get('cwd'))
+                self._send(job.to_dict())
+            elif action == 'status':
+                self._send(self.server.daemon.status(req.get('job')))
+            elif action == 'logs':
+                self._stream_logs(req.get('job'), req.get('follow', False))
+            else:
+                self._send({'error': "Unknown action %r" % (action)})
+        except (KeyError, ValueError) as e:
+            self._send({'error': str(e)})
+        except socket.error:
+            # Client went away
+            pass
+        except (IOError, OSError, AttributeError, TypeError) as e:
+            # Still answer (the client would otherwise get nothing back)
+            traceback.print_exc(file=sys.stdout)
+            self._send({'error': "Unable to handle request: %s" % (e)})
+
+    def _stream_logs(self, job_id, follow):
+        job = self.server.daemon.get(job_id)
+        with open(job.log_fn, 'rb') as fh:
+            while True:
+                finished = job.finished
+                data = fh.read(65536)
+                if data:
+                    self._send({'log': data})
+                    continue
+                if finished or not follow:
+                    break
+                time.sleep(0.25)
+        self._send(job.to_dict())
+
+
+class _Server(SocketServer.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, daemon):
+        self.daemon = daemon
+        SocketServer.ThreadingUnixStreamServer.__init__(self, socket_path,
+                                                        _Handler)
+
+
+class Daemon(object):
+    def __init__(self, build_mod, socket_path, state_dir, max_jobs=2,
+                 group=None):
+        self.build_mod = build_mod
+        self.socket_path = socket_path
+        # Besides the server user (and root) who can use the server
+        self.group = group
+        self.job_dir = os.path.join(state_dir, 'jobs')
+        self.max_jobs = max_jobs
+        self.jobs = {}
+        self.queue = Queue.Queue()
+        # Only one fork at a time, so children don't inherit half
+        # updated state from another worker
+        self.fork_lock = threading.Lock()
+        # One warm up per root source at a time (different sources are
+        # warmed up at the same time)
+        self.warm_locks = {}
+        self.warm_locks_lock = threading.Lock()
+
+    def allowed(self, uid):
+        # Builds run as the server user (usually root), so anyone who can
+        # submit one can do what that user can do...
+        if uid in (0, os.geteuid()):
+            return True
+        if self.group is None:
+            return False
+        try:
+            user = pwd.getpwuid(uid)
+            group = grp.getgrnam(self.group)
+        except KeyError:
+            return False
+        return user.pw_gid == group.gr_gid or user.pw_name in group.gr_mem
+
+    def submit(self, config_blob, args, cwd=None):
+        # Make sure its usable before queuing it up
+        try:
+            config = util.load_yaml(config_blob) or {}
+        except util.yaml.YAMLError as e:
+            raise ValueError("Invalid yaml config: %s" % (e))
+        if not isinstance(config, dict):
+            raise ValueError("Invalid config: expected a mapping and not %s"
+                             % (type(config).__name__))
+        errors = modules.REGISTRY.validate(config)
+        if errors:
+            raise ValueError("Invalid config: %s" % ("; ".join(errors)))
+        job = Job(self.job_dir, config_blob, args, cwd)
+        self.jobs[job.job_id] = job
+        self.queue.put(job)
+        print("Queued job %s with options %s." % (util.quote(job.job_id),
+                                                  job.args))
+        return job
+
+    def get(self, job_id):
+        try:
+            return self.jobs[job_id]
+        except KeyError:
+            raise KeyError("Unknown job %r" % (job_id))
+
+    def status(self, job_id=None):
+        if job_id:
+            return self.get(job_id).to_dict()
+        jobs = sorted(self.jobs.values(), key=lambda j: j.submitted_on)
+        return {'jobs': [j.to_dict() for j in jobs]}
+
+    def _warm_lock(self, config):
+        key = json.dumps(config.get('download'), sort_keys=True)
+        with self.warm_locks_lock:
+            if key not in self.warm_locks:
+                self.warm_locks[key] = threading.Lock()
+            return self.warm_locks[key]
+
+    def _warm(self, job):
+        # Fetch (and scan) the root source in the server so that it stays
+        # in memory for this and later builds (the children inherit it)
+        try:
+            config = util.load_yaml(util.load_file(job.config_fn))
+            with self._warm_lock(config):
+                # Relative paths are relative to where it was submitted from
+                root_down = self.build_mod.download_root(config, job.cwd)
+                root_down.usage()
+        except (IOError, OSError, ValueError, KeyError, RuntimeError,
+                util.yaml.YAMLError):
+            # The build itself will fail (and log why) in the same way
+            print("Warming up for job %s failed:" % (util.quote(job.job_id)))
+            traceback.print_exc(file=sys.stdout)
+
+    def _run(self, job):
+        job.state = RUNNING
+        job.started_on = time.time()
+        print("Starting job %s." % (util.quote(job.job_id)))
+        self._warm(job)
+        with self.fork_lock:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                rc = 1
+                try:
+                    log_fd = os.open(job.log_fn, os.O_WRONLY | os.O_APPEND)
+                    os.dup2(log_fd, sys.stdout.fileno())
+                    os.dup2(log_fd, sys.stderr.fileno())
+                    # So the output is in order with what commands output
+                    sys.stdout = os.fdopen(sys.stdout.fileno(), 'wb', 0)
+                    sys.stderr = os.fdopen(sys.stderr.fileno(), 'wb', 0)
+                    if job.cwd:
+                        os.chdir(job.cwd)
+                    rc = self.build_mod.main(job.args +
+                                             ['-c', job.config_fn])
+                except SystemExit as e:
+                    rc = e.code
+                except Exception:  # pylint: disable=W0703
+                    # Whatever happens the child must not return into
+                    # the server (its threads and socket)
+                    traceback.print_exc(file=sys.stdout)
+                finally:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    if not isinstance(rc, int):
+                        rc = 1
+                    # Skips the cleanup (atexit, buffers) of the server
+                    os._exit(rc)  # pylint: disable=W0212
+        (_pid, status) = os.waitpid(pid, 0)
+        job.exit_code = os.WEXITSTATUS(status)
+        job.finished_on = time.time()
+        if job.exit_code == 0:
+            job.state = DONE
+        else:
+            job.state = FAILED
+        print("Job %s finished with %s (after %.2f seconds)." %
+              (util.quote(job.job_id), job.exit_code,
+               job.finished_on - job.started_on))
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            try:
+                self._run(job)
+            except Exception:  # pylint: disable=W0703
+                # A worker has to outlive any one job going wrong
+                job.state = FAILED
+                job.finished_on = time.time()
+                traceback.print_exc(file=sys.stdout)
+
+    def serve(self):
+        util.del_file(self.socket_path)
+        server = _Server(self.socket_path, self)
+        # Connections are checked as well (see allowed), this just stops
+        # others from connecting in the first place
+        if self.group is None:
+            os.chmod(self.socket_path, 0600)
+        else:
+            os.chown(self.socket_path, -1, grp.getgrnam(self.group).gr_gid)
+            os.chmod(self.socket_path, 0660)
+        for _i in range(0, self.max_jobs):
+            th = threading.Thread(target=self._worker)
+            th.daemon = True
+            th.start()
+        print("Serving builds on %s (running up to %s at once)." %
+              (util.quote(self.socket_path), self.max_jobs))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            util.del_file(self.socket_path)
+
+
+def request(socket_path, data):
+    # Sends a request to the server and yields back each response
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    try:
+        sock.sendall("%s\n" % (json.dumps(data)))
+        fh = sock.makefile('rb')
+        for line in fh:
+            yield json.loads(line)
+    finally:
+        sock.close()
@@ -0,0 +1,142 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import hashlib
+import json
+import os
+
+from builder import util
+
+# Block delta format:
+#
+# MAGIC
+# <json header line> (the new manifest + which chunks changed)
+# <the data of each changed chunk, in the order listed in the header>
+MAGIC = 'IMGDELTA1\n'
+
+CHUNK_SIZE = 1024 * 1024
+ROUTINE = 'sha1'
+
+
+def _chunks(path, chunk_size):
+    with open(path, 'rb') as fh:
+        while True:
+            chunk = fh.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def make_manifest(path, chunk_size=CHUNK_SIZE, routine=ROUTINE):
+    digests = []
+    for chunk in _chunks(path, chunk_size):
+        digests.append(hashlib.new(routine, chunk).hexdigest())
+    return {
+        'chunk_size': chunk_size,
+        'routine': routine,
+        'size': os.path.getsize(path),
+        'chunks': digests,
+    }
+
+
+def load_manifest(path):
+    return json.loads(util.load_file(path))
+
+
+def write_manifest(manifest, path):
+    util.write_file(path, "%s\n" % (json.dumps(manifest)))
+
+
+def changed_chunks(old_manifest, new_manifest):
+    old_chunks = old_manifest['chunks']
+    changed = []
+    for (i, digest) in enumerate(new_manifest['chunks']):
+        if i >= len(old_chunks) or old_chunks[i] != digest:
+            changed.append(i)
+    return changed
+
+
+def make_delta(new_path, old_manifest, out_fn):
+    # Chunk the new image the same way the old one was so they compare
+    new_manifest = make_manifest(new_path, old_manifest['chunk_size'],
+                                 old_manifest['routine'])
+    changed = changed_chunks(old_manifest, new_manifest)
+    header = {
+        'base_chunks': len(old_manifest['chunks']),
+        'manifest': new_manifest,
+        'changed': changed,
+    }
+    chunk_size = new_manifest['chunk_size']
+    with open(new_path, 'rb') as in_fh:
+        with open(out_fn, 'wb') as out_fh:
+            out_fh.write(MAGIC)
+            out_fh.write("%s\n" % (json.dumps(header)))
+            for i in changed:
+                in_fh.seek(i * chunk_size)
+                out_fh.write(in_fh.read(chunk_size))
+    return (new_manifest, changed)
+
+
+def read_header(delta_fn):
+    with open(delta_fn, 'rb') as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise IOError("File %r is not a block delta" % (delta_fn))
+        return (json.loads(fh.readline()), fh.tell())
+
+
+def apply_delta(base_path, delta_fn, out_fn):
+    (header, data_offset) = read_header(delta_fn)
+    manifest = header['manifest']
+    chunk_size = manifest['chunk_size']
+    routine = manifest['routine']
+    changed = dict((i, pos) for (pos, i) in enumerate(header['changed']))
+    zero_chunk = '\0' * chunk_size
+    with open(base_path, 'rb') as base_fh:
+        with open(delta_fn, 'rb') as delta_fh:
+            with open(out_fn, 'wb') as out_fh:
+                for (i, digest) in enumerate(manifest['chunks']):
+                    if i in changed:
+                        delta_fh.seek(data_offset + changed[i] * chunk_size)
+                        chunk = delta_fh.read(chunk_size)
+                    else:
+                        base_fh.seek(i * chunk_size)
+                        chunk = base_fh.read(chunk_size)
+                    # The last chunk can be shorter than the rest
+                    if i == len(manifest['chunks']) - 1:
+                        chunk = chunk[0:manifest['size'] - i * chunk_size]
+                    if hashlib.new(routine, chunk).hexdigest() != digest:
+                        raise IOError("Chunk %s of %r does not match the"
+                                      " delta manifest (wrong base"
+                                      " image?)" % (i, out_fn))
+                    # Keep the output sparse where the image is empty
+                    if chunk == zero_chunk[0:len(chunk)]:
+                        out_fh.seek(len(chunk), os.SEEK_CUR)
+                    else:
+                        out_fh.write(chunk)
+                out_fh.truncate(manifest['size'])
+    return manifest
+
+
+def verify(path, manifest):
+    # Returns the indexes of the chunks that don't match
+    actual = make_manifest(path, manifest['chunk_size'], manifest['routine'])
+    bad = []
+    if actual['size'] != manifest['size']:
+        bad.append(-1)
+    for (i, digest) in enumerate(manifest['chunks']):
+        if i >= len(actual['chunks']) or actual['chunks'][i] != digest:
+            bad.append(i)
+    return bad
@@ -0,0 +1,262 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# Lays out the raw image (its partition table and filesystem) and cleans up
+# the filesystem in it afterwards (compacting and shrinking it).
+
+from __future__ import print_function
+
+import os
+import tempfile
+
+from builder import util
+
+SECTOR_SIZE = 512
+
+# Start the first partition on a 1 MiB boundary so that it is aligned for
+# 4K sector and SSD backed storage (the old style of starting at sector 63
+# makes many guest writes a read-modify-write).
+PART_ALIGNMENT = 1024 * 1024
+
+# Partition table types we know how to create
+PART_TABLES = ['msdos', 'gpt']
+
+# GPT needs its primary header + entries at the start (34 sectors) and keeps
+# a backup copy of the header + entries in the last 33 sectors of the disk
+GPT_HEAD_SECTORS = 34
+GPT_TAIL_SECTORS = 33
+
+# Where mke2fs reads its defaults from (see mke2fs.conf(5))
+MKE2FS_CONFIG = '/etc/mke2fs.conf'
+
+# The usage type mke2fs picks for a filesystem smaller than each size
+USAGE_TYPES = [
+    (3 * 1024 ** 2, 'floppy'),
+    (512 * 1024 ** 2, 'small'),
+    (4 * 1024 ** 4, 'default'),
+    (16 * 1024 ** 4, 'big'),
+]
+HUGE_USAGE_TYPE = 'huge'
+
+# Bytes per inode in the mke2fs built-in config (used when there is no
+# mke2fs.conf), when a mke2fs.conf lacks [defaults] inode_ratio it uses 8192
+BUILTIN_INODE_RATIOS = {
+    'defaults': 16384,
+    'floppy': 8192,
+    'small': 4096,
+    'big': 32768,
+    'huge': 65536,
+}
+
+
+def partition_overhead(alignment, table):
+    # How much of the image is not usable by the partition
+    reserved = alignment
+    if table == 'gpt':
+        reserved += GPT_TAIL_SECTORS * SECTOR_SIZE
+    return reserved
+
+
+def partition_geometry(image_size, alignment, table):
+    if alignment <= 0 or alignment % SECTOR_SIZE:
+        raise ValueError("Partition alignment %s is not a positive multiple"
+                         " of the %s byte sector size" % (alignment,
+                                                          SECTOR_SIZE))
+    start = alignment // SECTOR_SIZE
+    end = (image_size // SECTOR_SIZE) - 1
+    if table == 'gpt':
+        if start < GPT_HEAD_SECTORS:
+            raise ValueError("Partition alignment %s leaves no room for the"
+                             " gpt header" % (alignment))
+        end -= GPT_TAIL_SECTORS
+    if end < start:
+        raise ValueError("Image size %s is too small for a partition"
+                         " aligned at %s" % (image_size, alignment))
+    # The (offset, size) of the partition in bytes
+    return (start * SECTOR_SIZE, (end - start + 1) * SECTOR_SIZE)
+
+
+def merge_extended(mkfs_args):
+    # Mke2fs only uses the last -E given, so combine them all into one
+    merged = []
+    extended = []
+    args = list(mkfs_args)
+    while args:
+        arg = args.pop(0)
+        if arg == '-E' and args:
+            extended.append(args.pop(0))
+        else:
+            merged.append(arg)
+    if extended:
+        merged.extend(['-E', ",".join(extended)])
+    return merged
+
+
+def mke2fs_inode_ratios(config_fn=None):
+    # The inode_ratio of [defaults] and of each [fs_types] stanza
+    if not config_fn:
+        config_fn = os.environ.get('MKE2FS_CONFIG') or MKE2FS_CONFIG
+    contents = util.load_file(config_fn, quiet=True)
+    if contents is None:
+        return dict(BUILTIN_INODE_RATIOS)
+    ratios = {'defaults': 8192}
+    section = None
+    stanza = None
+    for line in contents.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if line.startswith('['):
+            section = line.strip('[]').strip()
+            stanza = None
+        elif line.endswith('{'):
+            stanza = line[0:-1].split('=', 1)[0].strip()
+        elif line == '}':
+            stanza = None
+        elif '=' in line:
+            (key, value) = [p.strip() for p in line.split('=', 1)]
+            if key != 'inode_ratio':
+                continue
+            if section == 'defaults' and not stanza:
+                name = 'defaults'
+            elif section == 'fs_types' and stanza:
+                name = stanza
+            else:
+                continue
+            try:
+                ratios[name] = int(value)
+            except ValueError:
+                pass
+    return ratios
+
+
+def default_inodes(fs_size, fs_type, config_fn=None):
+    # About how many inodes mke2fs makes by itself, the usage type (picked
+    # by size) overrides the filesystem type which overrides the defaults
+    usage = HUGE_USAGE_TYPE
+    for (limit, name) in USAGE_TYPES:
+        if fs_size < limit:
+            usage = name
+            break
+    ratios = mke2fs_inode_ratios(config_fn)
+    ratio = ratios['defaults']
+    for name in [fs_type, usage]:
+        ratio = ratios.get(name, ratio)
+    return fs_size // ratio
+
+
+def format_blank(ctx, size, inodes=None, fs_uuid=None):
+    raw_fn = ctx.raw_fn
+    fs_type = ctx.options.fs_type
+    table = ctx.options.part_table
+    print("Creating the image output file %s (scratch-version)."
+          % (util.quote(raw_fn)))
+    with open(raw_fn, 'w+') as o_fh:
+        o_fh.truncate(0)
+        cmd = ['qemu-img', 'create', '-f',
+               'raw', raw_fn, size]
+        util.subp(cmd)
+
+    part = partition_geometry(os.path.getsize(raw_fn),
+                              ctx.options.alignment, table)
+    print("Creating a %s partition table in %s (partition at byte %s)."
+          % (util.quote(table), util.quote(raw_fn), part[0]))
+    start = part[0] // SECTOR_SIZE
+    end = start + (part[1] // SECTOR_SIZE) - 1
+    cmd = ['parted', '-s', '-a', 'none', raw_fn,
+           'unit', 's',
+           'mklabel', table,
+           'mkpart', 'primary', '%ss' % (start), '%ss' % (end)]
+    util.subp(cmd)
+
+    print("Creating a filesystem of type %s in %s."
+          % (util.quote(fs_type),
+             util.quote(raw_fn)))
+
+    # Get a filesystem on it
+    with ctx.loops.attached(raw_fn, *part) as devname:
+        cmd = ['mkfs.%s' % (fs_type)]
+        # Only ask for more inodes than mke2fs would make, never less
+        if (inodes and fs_type.startswith('ext') and
+                inodes > default_inodes(part[1], fs_type)):
+            cmd.extend(['-N', str(inodes)])
+        mkfs_args = []
+        if ctx.profile:
+            mkfs_args.extend(ctx.profile['mkfs'])
+        env = None
+        if fs_uuid and fs_type.startswith('ext'):
+            # Avoid the random uuid, hash seed and the creation time
+            mkfs_args.extend(['-U', str(fs_uuid),
+                              '-E', 'hash_seed=%s' % (fs_uuid)])
+            env = dict(os.environ)
+            env['E2FSPROGS_FAKE_TIME'] = str(util.build_epoch())
+        cmd.extend(merge_extended(mkfs_args))
+        cmd.append(devname)
+        util.subp(cmd, env=env)
+    return part
+
+
+def dd_off(loop_dev, tmp_dir, block_size='32768k'):
+    tmp_fn = tempfile.mktemp(dir=tmp_dir, suffix='.raw')
+    cmd = [
+        'dd',
+        'if=%s' % (loop_dev),
+        'bs=%s' % (block_size),
+        'of=%s' % (tmp_fn),
+        # Keep any discarded (zero) blocks as holes in the copy
+        'conv=sparse',
+    ]
+    util.subp(cmd, capture=False)
+    return tmp_fn
+
+
+def trim_fs(root_dir):
+    # Have the mounted filesystem discard its unused blocks, which the loop
+    # device turns into holes punched in the backing raw file.
+    try:
+        util.subp(['fstrim', '-v', root_dir], capture=False)
+        return True
+    except util.ProcessExecutionError:
+        return False
+
+
+def zero_free(devname, raw_fn):
+    # Fallback for when discarding is not supported, zero the unused blocks
+    # of the (unmounted) filesystem and then turn those zeros into holes.
+    try:
+        util.subp(['zerofree', devname], capture=False)
+        util.subp(['fallocate', '--dig-holes', raw_fn], capture=False)
+        return True
+    except util.ProcessExecutionError:
+        return False
+
+
+def shrink_fs(raw_fn):
+    # Only works when the raw file is just the filesystem (no partitions)
+    print("Shrinking the filesystem in %s to its minimum size."
+          % (util.quote(raw_fn)))
+    util.subp(['e2fsck', '-f', '-y', raw_fn], rcs=[0, 1], capture=False)
+    util.subp(['resize2fs', '-M', raw_fn], capture=False)
+    (stdout, _stderr) = util.subp(['dumpe2fs', '-h', raw_fn])
+    info = {}
+    for line in stdout.splitlines():
+        if ':' in line:
+            (key, value) = line.split(':', 1)
+            info[key.strip()] = value.strip()
+    new_size = int(info['Block count']) * int(info['Block size'])
+    old_size = os.path.getsize(raw_fn)
+    with open(raw_fn, 'r+b') as fh:
+        fh.truncate(new_size)
+    print("Shrunk %s from %s to %s bytes." % (util.quote(raw_fn),
+                                              old_size, new_size))
@@ -13,3 +13,50 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
+
+import os
+
+from builder.downloader import directory
+from builder.downloader import tar_ball
+
+# The kinds of root filesystem sources (selected by the 'type' key of the
+# download config, or guessed from its 'from' key when not provided)
+DOWNLOADERS = {
+    'directory': directory.DirectoryDownloader,
+    'tarball': tar_ball.TarBallDownloader,
+}
+
+
+def get_downloader(config):
+    kind = config.get('type')
+    if not kind:
+        where_from = config.get('from')
+        kind = 'tarball'
+        if isinstance(where_from, basestring):
+            if (where_from.startswith('file://') or
+                    os.path.isdir(directory.local_path(where_from))):
+                kind = 'directory'
+    try:
+        cls = DOWNLOADERS[kind]
+    except KeyError:
+        raise ValueError("Unknown download type %r (known types are %s)"
+                         % (kind, ", ".join(sorted(DOWNLOADERS.keys()))))
+    return cls(config)
+
+
+def resolve_paths(config, base_dir=None):
+    # Makes the local paths of a download config absolute (relative to the
+    # given directory or the current one)
+    if not base_dir:
+        base_dir = os.getcwd()
+    config = dict(config)
+    config['cache_dir'] = os.path.join(base_dir,
+                                       config.get('cache_dir') or 'cache')
+    where_from = config.get('from')
+    if isinstance(where_from, basestring):
+        if where_from.startswith('file://'):
+            config['from'] = 'file://%s' % (os.path.join(
+                base_dir, directory.local_path(where_from)))
+        elif '://' not in where_from:
+            config['from'] = os.path.join(base_dir, where_from)
+    return config
@@ -0,0 +1,42 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+class Downloader(object):
+    # Something that can provide the contents of the root filesystem
+    def __init__(self, config):
+        self.config = config
+
+    def fetch(self):
+        # Get the source ready (ie download it), returns where it is
+        raise NotImplementedError()
+
+    def is_fetched(self):
+        # Whether what was fetched is still there (and can be reused)
+        return False
+
+    def populate(self, root_dir):
+        # Place the root filesystem contents into the (mounted) root_dir
+        raise NotImplementedError()
+
+    def usage(self, block_size=4096):
+        # How many bytes (rounded up to full blocks) and inodes the
+        # contents will need once placed into the root filesystem
+        raise NotImplementedError()
+
+    def digest(self, routine='md5'):
+        # A digest that changes when the contents change
+        raise NotImplementedError()
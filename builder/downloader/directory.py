@@ -0,0 +1,89 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from __future__ import print_function
+
+import hashlib
+import os
+import stat
+
+from builder import util
+
+from builder.downloader import base
+
+def local_path(where_from):
+    if where_from.startswith('file://'):
+        return where_from[len('file://'):]
+    return where_from
+
+
+class DirectoryDownloader(base.Downloader):
+    # Uses an already unpacked root filesystem tree
+    def __init__(self, config):
+        base.Downloader.__init__(self, config)
+        self.where_from = os.path.abspath(local_path(config['from']))
+
+    def fetch(self):
+        if not os.path.isdir(self.where_from):
+            raise IOError("Root directory %r does not exist"
+                          % (self.where_from))
+        return self.where_from
+
+    def is_fetched(self):
+        return os.path.isdir(self.where_from)
+
+    def populate(self, root_dir):
+        print("Copying 'root' directory %s to %s." %
+              (util.quote(self.where_from), util.quote(root_dir)))
+        util.copy_tree(self.where_from, root_dir)
+
+    def _walk(self):
+        for (path, dirs, files) in os.walk(self.where_from):
+            dirs.sort()
+            for name in sorted(dirs + files):
+                full_pth = os.path.join(path, name)
+                yield (full_pth, os.lstat(full_pth))
+
+    def usage(self, block_size=4096):
+        byte_am = 0
+        inode_am = 1
+        seen = set()
+        for (_full_pth, st) in self._walk():
+            # Hardlinks only use one inode (and one copy of the data)
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            inode_am += 1
+            if stat.S_ISREG(st.st_mode):
+                blocks = (st.st_size + block_size - 1) // block_size
+                byte_am += blocks * block_size
+            else:
+                byte_am += block_size
+        return (byte_am, inode_am)
+
+    def digest(self, routine='md5'):
+        # Hashing every file would take as long as copying them, so like
+        # rsync use the names, sizes, modes and modification times...
+        hasher = hashlib.new(routine)
+        for (full_pth, st) in self._walk():
+            rel_pth = os.path.relpath(full_pth, self.where_from)
+            hasher.update("%s %s %s %s %s %s\n" % (rel_pth, st.st_mode,
+                                                   st.st_uid, st.st_gid,
+                                                   st.st_size,
+                                                   int(st.st_mtime)))
+            if stat.S_ISLNK(st.st_mode):
+                hasher.update("%s\n" % (os.readlink(full_pth)))
+        return hasher.hexdigest()
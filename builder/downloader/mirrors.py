@@ -0,0 +1,170 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from __future__ import print_function
+
+import httplib
+import json
+import os
+import threading
+import time
+import urllib2
+
+from builder import util
+
+# How much of the file each mirror is asked for when racing them
+PROBE_BYTES = 256 * 1024
+
+# How much a new throughput measurement counts vs the remembered one
+RATE_WEIGHT = 0.5
+
+
+class MirrorStats(object):
+    # Remembers how each mirror performed between runs
+    def __init__(self, cache_dir):
+        self.path = os.path.join(cache_dir, 'mirrors.json')
+        self.stats = {}
+        try:
+            self.stats = json.loads(util.load_file(self.path, quiet=True)
+                                    or '{}')
+        except ValueError:
+            pass
+
+    def get(self, url):
+        return self.stats.setdefault(url, {
+            'rate': 0.0,
+            'failures': 0,
+            'successes': 0,
+        })
+
+    def record(self, url, byte_am, elapsed, failed=False):
+        entry = self.get(url)
+        if failed:
+            entry['failures'] += 1
+        else:
+            entry['successes'] += 1
+        if byte_am > 0 and elapsed > 0:
+            rate = byte_am / elapsed
+            if entry['rate'] > 0:
+                rate = (RATE_WEIGHT * rate +
+                        (1 - RATE_WEIGHT) * entry['rate'])
+            entry['rate'] = rate
+
+    def save(self):
+        contents = json.dumps(self.stats, indent=4)
+        try:
+            util.write_file(self.path, "%s\n" % (contents))
+        except (IOError, OSError):
+            pass
+
+
+def probe(url, timeout, byte_am=PROBE_BYTES):
+    # Returns the throughput (bytes/second) of the first bytes of the file
+    req = urllib2.Request(url)
+    req.add_header('Range', 'bytes=0-%s' % (byte_am - 1))
+    start = time.time()
+    rh = urllib2.urlopen(req, timeout=timeout)
+    try:
+        status = rh.getcode()
+        if status not in xrange(200, 300):
+            raise IOError("Probe of %s failed due to status %s"
+                          % (url, status))
+        got = 0
+        while got < byte_am:
+            data = rh.read(min(65536, byte_am - got))
+            if not data:
+                break
+            got += len(data)
+    finally:
+        rh.close()
+    return got / max(time.time() - start, 0.001)
+
+
+def rank(urls, stats, timeout):
+    # Race all the mirrors at once and order them fastest first, mixing
+    # in how they did in earlier runs (mirrors that failed go last).
+    rates = {}
+
+    def run_probe(url):
+        try:
+            rates[url] = probe(url, timeout)
+        except (IOError, ValueError, httplib.HTTPException) as e:
+            print("Mirror %s failed probing: %s" % (util.quote(url), e))
+            rates[url] = None
+
+    threads = []
+    for url in urls:
+        th = threading.Thread(target=run_probe, args=(url,))
+        th.daemon = True
+        th.start()
+        threads.append(th)
+    for th in threads:
+        th.join(timeout * 2)
+
+    def score(url):
+        entry = stats.get(url)
+        rate = rates.get(url)
+        if rate is None:
+            return (0, -entry['failures'], entry['rate'])
+        if entry['rate'] > 0:
+            rate = RATE_WEIGHT * rate + (1 - RATE_WEIGHT) * entry['rate']
+        # Mirrors that often fail part way through are less attractive
+        reliability = ((entry['successes'] + 1.0) /
+                       (entry['successes'] + entry['failures'] + 1.0))
+        return (1, 0, rate * reliability)
+
+    ranked = sorted(urls, key=score, reverse=True)
+    for url in ranked:
+        rate = rates.get(url)
+        if rate is None:
+            desc = 'failed'
+        else:
+            desc = "%.2f KB/s" % (rate / 1024.0)
+        print("Mirror %s probed at %s." % (util.quote(url), desc))
+    return ranked
+
+
+def fetch(urls, where_to, cache_dir, timeout=5, rounds=2):
+    stats = MirrorStats(cache_dir)
+    try:
+        ranked = rank(urls, stats, timeout)
+        received = 0
+        for _i in range(0, rounds):
+            for url in ranked:
+                print("Fetching from mirror %s (starting at byte %s)." %
+                      (util.quote(url), received))
+                start = time.time()
+                try:
+                    util.download_url(url, where_to, timeout,
+                                      offset=received)
+                    byte_am = os.path.getsize(where_to) - received
+                    stats.record(url, byte_am, time.time() - start)
+                    return url
+                except (IOError, ValueError, RuntimeError,
+                        httplib.HTTPException) as e:
+                    # Keep what we got so that the next mirror can continue
+                    # from there (if it supports ranged requests).
+                    now_received = 0
+                    if os.path.isfile(where_to):
+                        now_received = os.path.getsize(where_to)
+                    stats.record(url, now_received - received,
+                                 time.time() - start, failed=True)
+                    received = now_received
+                    print("Mirror %s failed after %s bytes: %s" %
+                          (util.quote(url), received, e))
+        raise IOError("All mirrors (%s) failed" % (", ".join(urls)))
+    finally:
+        stats.save()
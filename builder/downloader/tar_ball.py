@@ -14,21 +14,39 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from __future__ import print_function
+
 import os
+import tarfile
 
 from builder import util
 
+from builder.downloader import base
+from builder.downloader import mirrors
+
 import json
 
 
-class TarBallDownloader(object):
+class TarBallDownloader(base.Downloader):
     def __init__(self, config):
+        base.Downloader.__init__(self, config)
+        self.arch_path = None
+        self._usage = {}
         self.cache_dir = config.get('cache_dir') or 'cache'
         self.where_from = config['from']
         self.root_file = config.get('root_file')
 
+    def _mirrors(self):
+        if isinstance(self.where_from, (list, tuple)):
+            return list(self.where_from)
+        return None
+
     def _check_cache(self):
-        cache_name = util.hash_blob(self.where_from, 'md5')
+        cache_key = self.where_from
+        urls = self._mirrors()
+        if urls:
+            cache_key = "\n".join(sorted(urls))
+        cache_name = util.hash_blob(cache_key, 'md5')
         cache_name = cache_name[0:8]
         full_pth = os.path.join(self.cache_dir, "%s.tar.gz" % (cache_name))
         if os.path.isfile(full_pth):
@@ -52,6 +70,22 @@ class TarBallDownloader(object):
                     util.copy(root_gz, arch_path)
         return arch_path
 
+    def digest(self, routine='md5'):
+        # The digest of the (adjusted) cached archive, which is remembered
+        # in the cache metadata so it only has to be computed once.
+        (cache_pth, _exists_there) = self._check_cache()
+        meta_fn = "%s.json" % (cache_pth)
+        meta_js = {}
+        try:
+            meta_js = json.loads(util.load_file(meta_fn, quiet=True) or '{}')
+        except ValueError:
+            pass
+        key = "%s_digest" % (routine)
+        if key not in meta_js:
+            meta_js[key] = util.hash_file(cache_pth, routine)
+            util.write_file(meta_fn, "%s\n" % (json.dumps(meta_js, indent=4)))
+        return meta_js[key]
+
     def download(self):
         (cache_pth, exists_there) = self._check_cache()
         if exists_there:
@@ -59,8 +93,12 @@ class TarBallDownloader(object):
         print("Downloading from: %s" % (util.quote(self.where_from)))
         util.ensure_dirs([os.path.dirname(cache_pth)])
         print("To: %s" % (util.quote(cache_pth)))
-        util.download_url(self.where_from, cache_pth)
+        urls = self._mirrors()
         try:
+            if urls:
+                mirrors.fetch(urls, cache_pth, self.cache_dir)
+            else:
+                util.download_url(self.where_from, cache_pth)
             meta_js = {
                 'cached_on': util.time_rfc2822(),
                 'from': self.where_from,
@@ -72,3 +110,38 @@ class TarBallDownloader(object):
         except:
             util.del_file(cache_pth)
             raise
+
+    def fetch(self):
+        self.arch_path = self.download()
+        self._usage = {}
+        return self.arch_path
+
+    def is_fetched(self):
+        return bool(self.arch_path) and os.path.isfile(self.arch_path)
+
+    def populate(self, root_dir):
+        print("Extracting 'root' tarball %s to %s." %
+              (util.quote(self.arch_path), util.quote(root_dir)))
+        util.subp(['tar', '-xzf', self.arch_path, '-C', root_dir])
+
+    def usage(self, block_size=4096):
+        # Scanning the whole archive is slow, so remember the answer
+        if block_size not in self._usage:
+            self._usage[block_size] = self._scan_usage(block_size)
+        return self._usage[block_size]
+
+    def _scan_usage(self, block_size):
+        byte_am = 0
+        inode_am = 0
+        tar_fh = tarfile.open(self.arch_path, 'r:*')
+        try:
+            for member in tar_fh:
+                inode_am += 1
+                if member.isfile():
+                    blocks = (member.size + block_size - 1) // block_size
+                    byte_am += blocks * block_size
+                else:
+                    byte_am += block_size
+        finally:
+            tar_fh.close()
+        return (byte_am, inode_am)
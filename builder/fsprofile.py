@@ -0,0 +1,109 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# Filesystem build profiles, which trade safety for speed while the image is
+# being populated and are undone before the image is converted.
+
+from __future__ import print_function
+
+import json
+import os
+
+from builder import util
+
+# Filesystem creation and mount tunings that are used while the image is
+# being populated (extraction, modules), these only apply to journaled ext
+# filesystems and anything they turn off is turned back on before conversion.
+FS_PROFILES = {
+    'none': {
+        'mkfs': [],
+        'mount': [],
+        'journal': True,
+    },
+    # Keep the journal, but only journal metadata and skip barriers
+    'writeback': {
+        'mkfs': ['-E', 'lazy_itable_init=1,lazy_journal_init=1'],
+        'mount': ['noatime', 'data=writeback', 'barrier=0'],
+        'journal': True,
+    },
+    # No journal at all (it gets added back afterwards)
+    'nojournal': {
+        'mkfs': ['-O', '^has_journal', '-E', 'lazy_itable_init=1'],
+        'mount': ['noatime'],
+        'journal': False,
+    },
+}
+
+# Filesystems the build profiles can be used with
+JOURNALED_FS = ['ext3', 'ext4']
+
+
+def get_profile(name, fs_type):
+    # Ext2 has no journal to tune (or to add back afterwards)
+    if fs_type not in JOURNALED_FS and name != 'none':
+        print("Build profile %s does not apply to %s, not using it." %
+              (util.quote(name), util.quote(fs_type)))
+        name = 'none'
+    profile = dict(FS_PROFILES[name])
+    profile['name'] = name
+    profile['fs_type'] = fs_type
+    return profile
+
+
+def restore_fs(ctx):
+    # Undo whatever the build profile turned off and make sure the
+    # filesystem is left in a clean (fsck'd) state.
+    profile = ctx.profile
+    if profile['name'] == 'none':
+        return
+    print("Restoring production settings of the %s build profile." %
+          (util.quote(profile['name'])))
+    with ctx.attached() as devname:
+        if not profile['journal'] and profile['fs_type'] in JOURNALED_FS:
+            util.subp(['tune2fs', '-O', 'has_journal', devname],
+                      capture=False)
+        # Exit code 1 means errors were corrected...
+        util.subp(['e2fsck', '-f', '-y', devname], rcs=[0, 1],
+                  capture=False)
+
+
+def timings_fn(config):
+    down_cfg = config.get('download') or {}
+    return os.path.join(down_cfg.get('cache_dir') or 'cache', 'timings.json')
+
+
+def report_extraction(config, profile, byte_am, elapsed):
+    rate = byte_am / max(elapsed, 0.001)
+    print("Extracted %s bytes in %.2f seconds (%.2f MB/s) using the %s"
+          " build profile." % (byte_am, elapsed, rate / (1024 * 1024),
+                               util.quote(profile['name'])))
+    # Compare against earlier builds (which may have used other profiles)
+    fn = timings_fn(config)
+    timings = {}
+    try:
+        timings = json.loads(util.load_file(fn, quiet=True) or '{}')
+    except ValueError:
+        pass
+    for (name, other_rate) in sorted(timings.items()):
+        if name != profile['name'] and other_rate > 0:
+            print("That is %.2fx the extraction rate of the last build using"
+                  " the %s build profile." % (rate / other_rate,
+                                              util.quote(name)))
+    timings[profile['name']] = rate
+    try:
+        util.write_file(fn, "%s\n" % (json.dumps(timings, indent=4)))
+    except (IOError, OSError):
+        pass
@@ -0,0 +1,139 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# Finds the kernel and ramdisk of an image (regenerating the ramdisk when
+# the image only has a base initrd) and caches the regenerated ramdisks.
+
+from __future__ import print_function
+
+import hashlib
+import os
+import shutil
+
+from builder import util
+
+# Used for the cache key of regenerated initrds
+CACHE_ROUTINE = 'md5'
+
+# Files (relative to the root) which affect how initrds are regenerated
+INITRD_CONFIGS = [
+    ('etc', 'dracut.conf'),
+    ('etc', 'sysconfig', 'mkinitrd'),
+]
+
+
+def cache_dir(config):
+    where = config.get('initrd_cache_dir')
+    if not where:
+        down_cfg = config.get('download') or {}
+        where = os.path.join(down_cfg.get('cache_dir') or 'cache', 'initrd')
+    return where
+
+
+def cache_key(root_dir, kid):
+    # Regenerated initrds only depend on the kernel version, the modules
+    # that kernel has and the configs of the tools that generate them...
+    hasher = hashlib.new(CACHE_ROUTINE)
+    hasher.update("%s\n" % (kid))
+    mod_dir = util.abs_join(root_dir, 'lib', 'modules', kid)
+    for (path, dirs, files) in os.walk(mod_dir):
+        dirs.sort()
+        for fn in sorted(files):
+            full_fn = os.path.join(path, fn)
+            hasher.update("%s\n" % (os.path.relpath(full_fn, mod_dir)))
+            if os.path.islink(full_fn):
+                hasher.update(os.readlink(full_fn))
+            elif os.path.isfile(full_fn):
+                with open(full_fn, 'rb') as fh:
+                    util.pipe_in_out(fh, util.HashWriter(hasher),
+                                     chunk_size=1024 * 1024)
+    cfg_fns = [util.abs_join(root_dir, *pieces) for pieces in INITRD_CONFIGS]
+    cfg_dir = util.abs_join(root_dir, 'etc', 'dracut.conf.d')
+    if os.path.isdir(cfg_dir):
+        for fn in sorted(os.listdir(cfg_dir)):
+            cfg_fns.append(os.path.join(cfg_dir, fn))
+    for fn in cfg_fns:
+        contents = util.load_file(fn, quiet=True)
+        if contents is not None:
+            hasher.update("%s\n" % (os.path.relpath(fn, root_dir)))
+            hasher.update(contents)
+    return hasher.hexdigest()
+
+
+def make_initrd(root_dir, base_fn, kid, cache_to):
+    rd_fn = "initramfs-%s.img" % (kid)
+    boot_rd_fn = util.abs_join(root_dir, "boot", rd_fn)
+    cache_fn = None
+    if cache_to:
+        cache_fn = util.abs_join(cache_to,
+                                 "%s.img" % (cache_key(root_dir, kid)))
+        if os.path.isfile(cache_fn):
+            print("Using cached initramfs %s for kernel %s." %
+                  (util.quote(cache_fn), util.quote(kid)))
+            util.copy(cache_fn, boot_rd_fn)
+            return rd_fn
+    cmd = ['chroot', root_dir,
+           '/sbin/mkinitrd', '-f',
+           os.path.join('/boot', base_fn),
+           kid]
+    util.subp(cmd, capture=False)
+    if not os.path.isfile(boot_rd_fn):
+        return None
+    if cache_fn:
+        print("Caching initramfs for kernel %s at %s." %
+              (util.quote(kid), util.quote(cache_fn)))
+        util.ensure_dir(cache_to)
+        # Copy then rename so that a partial copy is never found
+        tmp_fn = "%s.%s.tmp" % (cache_fn, os.getpid())
+        try:
+            util.copy(boot_rd_fn, tmp_fn)
+            os.rename(tmp_fn, cache_fn)
+        finally:
+            util.del_file(tmp_fn)
+    return rd_fn
+
+
+def harvest_boot(root_dir, img_dir, cache_to=None):
+    print("Copying off the ramdisk and kernel files.")
+    # Find the right files
+    fns = {}
+    for fn in os.listdir(util.abs_join(root_dir, 'boot')):
+        if fn.endswith('.img') and fn.startswith('initramfs-'):
+            fns['ramdisk'] = fn
+        if fn.startswith('vmlinuz-'):
+            fns['kernel'] = fn
+        if fn.startswith('initrd-') and fn.endswith('.img'):
+            fns['base'] = fn
+    rd_fn = fns.get('ramdisk')
+    k_fn = fns.get('kernel')
+    if not rd_fn and 'base' in fns:
+        kid = fns['base']
+        kid = kid[0:-len('.img')]
+        kid = kid[len('initrd-'):]
+        rd_fn = make_initrd(root_dir, fns['base'], kid, cache_to)
+        if os.path.isfile(util.abs_join(root_dir, "boot",
+                                        "vmlinuz-%s" % (kid))):
+            k_fn = "vmlinuz-%s" % (kid)
+    if not rd_fn:
+        raise RuntimeError("No initramfs-*.img file found")
+    if not k_fn:
+        raise RuntimeError("No vmlinuz-* file found")
+    util.ensure_dir(img_dir)
+    shutil.move(util.abs_join(root_dir, 'boot', rd_fn),
+                util.abs_join(img_dir, rd_fn))
+    shutil.move(util.abs_join(root_dir, 'boot', k_fn),
+                util.abs_join(img_dir, k_fn))
+    return (k_fn, rd_fn)
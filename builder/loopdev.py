@@ -0,0 +1,255 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from __future__ import print_function
+
+import contextlib
+import errno
+import fcntl
+import json
+import os
+import time
+
+from builder import util
+
+# Where the shared (between builds) loop/mount ownership state lives
+STATE_DIR = '/var/run/image-builder'
+
+# How many loop devices all builds on this host may have attached at once
+MAX_ATTACHED = 8
+
+
+def _proc_started(pid):
+    # The start time (in clock ticks since boot) of a process, used to
+    # notice when a pid has been reused by some other process...
+    try:
+        with open('/proc/%s/stat' % (pid), 'rb') as fh:
+            stat = fh.read()
+    except IOError:
+        return None
+    # The command name can contain spaces so skip past it first
+    fields = stat[stat.rfind(')') + 2:].split()
+    try:
+        return int(fields[19])
+    except (IndexError, ValueError):
+        return None
+
+
+def _owner_alive(entry):
+    pid = entry.get('owner')
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno != errno.EPERM:
+            return False
+    started = entry.get('started')
+    if started is not None and _proc_started(pid) != started:
+        return False
+    return True
+
+
+def undo(func, what, failed):
+    # Runs a detach/umount, when already failing (the real problem) one that
+    # fails too is left to be reaped instead of hiding that problem
+    try:
+        func(what)
+    except util.ProcessExecutionError:
+        if not failed:
+            raise
+
+
+class LoopManager(object):
+    def __init__(self, state_dir=STATE_DIR, max_attached=MAX_ATTACHED,
+                 wait_timeout=600, poll_delay=1):
+        self.state_dir = state_dir
+        self.state_fn = os.path.join(state_dir, 'loops.json')
+        self.lock_fn = os.path.join(state_dir, 'loops.lock')
+        self.max_attached = max_attached
+        self.wait_timeout = wait_timeout
+        self.poll_delay = poll_delay
+
+    def _owner(self):
+        pid = os.getpid()
+        return {
+            'owner': pid,
+            'started': _proc_started(pid),
+        }
+
+    def _load(self):
+        contents = util.load_file(self.state_fn, quiet=True)
+        state = {}
+        if contents:
+            try:
+                state = json.loads(contents)
+            except ValueError:
+                print("Ignoring corrupt loop state file %s."
+                      % (util.quote(self.state_fn)))
+        state.setdefault('loops', [])
+        state.setdefault('mounts', [])
+        return state
+
+    def _save(self, state):
+        # Write then rename so that nobody ever sees a partial file
+        tmp_fn = "%s.%s" % (self.state_fn, os.getpid())
+        util.write_file(tmp_fn, "%s\n" % (json.dumps(state, indent=4)))
+        os.rename(tmp_fn, self.state_fn)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        util.ensure_dir(self.state_dir)
+        with open(self.lock_fn, 'a') as lock_fh:
+            fcntl.flock(lock_fh, fcntl.LOCK_EX)
+            try:
+                state = self._load()
+                yield state
+                self._save(state)
+            finally:
+                fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+    def reap(self):
+        # Cleans up any mounts and loop devices left behind by builds
+        # that are no longer alive (crashed, killed...)
+        reaped = 0
+        with self._locked() as state:
+            mounts = []
+            for entry in state['mounts']:
+                if _owner_alive(entry):
+                    mounts.append(entry)
+                    continue
+                print("Reaping stale mount %s of dead build %s." %
+                      (util.quote(entry['target']), entry['owner']))
+                try:
+                    util.subp(['umount', '-l', entry['target']])
+                except util.ProcessExecutionError:
+                    pass
+                reaped += 1
+            state['mounts'] = mounts
+            loops = []
+            for entry in state['loops']:
+                if _owner_alive(entry):
+                    loops.append(entry)
+                    continue
+                print("Reaping stale loop device %s of dead build %s." %
+                      (util.quote(entry['device']), entry['owner']))
+                try:
+                    util.subp(['losetup', '-d', entry['device']])
+                except util.ProcessExecutionError:
+                    pass
+                reaped += 1
+            state['loops'] = loops
+        return reaped
+
+    def attach(self, filename, offset=None, sizelimit=None):
+        cmd = ['losetup']
+        if offset:
+            cmd.extend(['-o', str(offset)])
+        if sizelimit:
+            cmd.extend(['--sizelimit', str(sizelimit)])
+        cmd.extend(['--show', '-f', filename])
+        waited = 0
+        while True:
+            # Finding a free device and recording it happens under the lock
+            # so that concurrent builds can't race for the same device.
+            with self._locked() as state:
+                if len(state['loops']) < self.max_attached:
+                    (stdout, _stderr) = util.subp(cmd)
+                    devname = stdout.strip()
+                    entry = self._owner()
+                    entry.update({
+                        'device': devname,
+                        'file': os.path.abspath(filename),
+                        'offset': offset,
+                        'sizelimit': sizelimit,
+                    })
+                    state['loops'].append(entry)
+                    return devname
+            if waited == 0:
+                print("Waiting for one of the %s loop devices to be freed."
+                      % (self.max_attached))
+            if waited >= self.wait_timeout:
+                raise RuntimeError("Timed out waiting %s seconds for a free"
+                                   " loop device" % (waited))
+            time.sleep(self.poll_delay)
+            waited += self.poll_delay
+
+    def detach(self, devname, attempts=3):
+        for i in range(0, attempts):
+            try:
+                util.subp(['losetup', '-d', devname])
+                break
+            except util.ProcessExecutionError as e:
+                if i + 1 == attempts:
+                    # Leave it recorded so that it gets reaped later
+                    print("Failed detaching loop device %s: %s" %
+                          (util.quote(devname), e))
+                    raise
+                time.sleep(1)
+        with self._locked() as state:
+            state['loops'] = [entry for entry in state['loops']
+                              if entry['device'] != devname]
+
+    def mount(self, source, target, fs_type=None, options=None):
+        cmd = ['mount']
+        if fs_type:
+            cmd.extend(['-t', fs_type])
+        if options:
+            cmd.extend(['-o', ",".join(options)])
+        cmd.extend([source, target])
+        with self._locked() as state:
+            util.subp(cmd)
+            entry = self._owner()
+            entry.update({
+                'source': source,
+                'target': os.path.abspath(target),
+            })
+            state['mounts'].append(entry)
+
+    def umount(self, target, attempts=3):
+        target = os.path.abspath(target)
+        for i in range(0, attempts):
+            try:
+                util.subp(['umount', target])
+                break
+            except util.ProcessExecutionError as e:
+                if i + 1 == attempts:
+                    # Leave it recorded so that it gets reaped later
+                    print("Failed unmounting %s: %s" %
+                          (util.quote(target), e))
+                    raise
+                time.sleep(1)
+        with self._locked() as state:
+            state['mounts'] = [entry for entry in state['mounts']
+                               if entry['target'] != target]
+
+    @contextlib.contextmanager
+    def attached(self, filename, offset=None, sizelimit=None):
+        devname = self.attach(filename, offset, sizelimit)
+        failed = True
+        try:
+            yield devname
+            failed = False
+        finally:
+            undo(self.detach, devname, failed)
+
+    @contextlib.contextmanager
+    def mounted(self, source, target, fs_type=None, options=None):
+        self.mount(source, target, fs_type, options)
+        failed = True
+        try:
+            yield target
+            failed = False
+        finally:
+            undo(self.umount, target, failed)
@@ -0,0 +1,145 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# The build manifest (what a builds output depends on) and the output cache
+# that stores outputs by the digest of their manifest.
+
+from __future__ import print_function
+
+import copy
+import hashlib
+import json
+import os
+import shutil
+
+from builder import modules
+from builder import util
+
+# Used for the build manifest (and its digest)
+ROUTINE = 'sha256'
+
+# The options which change what a build outputs
+OPTIONS = [
+    'size', 'size_headroom', 'shrink', 'compact', 'fs_type', 'compress',
+    'strip_parts', 'alignment', 'part_table', 'fs_profile',
+    'delta_from', 'delta_format', 'profile',
+]
+
+
+def module_digest(mod):
+    src_fn = mod.__file__
+    if src_fn.endswith(('.pyc', '.pyo')):
+        src_fn = src_fn[0:-1]
+    return util.hash_blob(util.load_file(src_fn), ROUTINE)
+
+
+def builder_digest():
+    # The builder itself (build.py, the builder package and the templates)
+    pkg_dir = os.path.dirname(os.path.abspath(__file__))
+    top_dir = os.path.dirname(pkg_dir)
+    src_fns = [os.path.join(top_dir, 'build.py')]
+    for where in [pkg_dir, os.path.join(top_dir, 'templates')]:
+        for (path, dirs, files) in os.walk(where):
+            dirs.sort()
+            for fn in sorted(files):
+                if not fn.endswith(('.pyc', '.pyo')):
+                    src_fns.append(os.path.join(path, fn))
+    hasher = hashlib.new(ROUTINE)
+    for fn in src_fns:
+        hasher.update("%s\n" % (os.path.relpath(fn, top_dir)))
+        hasher.update(util.load_file(fn))
+    return hasher.hexdigest()
+
+
+def build_manifest(config, options, root_digest):
+    # Everything that goes into making the output, builds with the same
+    # manifest (in deterministic mode) produce the same output.
+    config = copy.deepcopy(config)
+    mods = config.pop('modules', None) or []
+    mod_config = copy.deepcopy(config)
+    down_cfg = config.pop('download', None) or {}
+    down_cfg.pop('cache_dir', None)
+    mod_digests = {}
+    input_digests = {}
+    for real_name in mods:
+        if not modules.canonical_name(real_name):
+            continue
+        mod = modules.REGISTRY.get(real_name)
+        mod_digests[real_name] = module_digest(mod)
+        # Modules can say which other files they will use
+        inputs_func = getattr(mod, 'inputs', None)
+        if inputs_func:
+            for fn in inputs_func(real_name,
+                                  copy.deepcopy(mod_config)) or []:
+                input_digests[os.path.abspath(fn)] = \
+                    util.hash_file(fn, ROUTINE)
+    opts = {}
+    for name in OPTIONS:
+        opts[name] = getattr(options, name, None)
+    if options.delta_from:
+        input_digests[os.path.abspath(options.delta_from)] = \
+            util.hash_file(options.delta_from, ROUTINE)
+    return {
+        'builder': builder_digest(),
+        'root': root_digest,
+        'download': down_cfg,
+        'modules': mods,
+        'module_sources': mod_digests,
+        'module_inputs': input_digests,
+        'config': config,
+        'options': opts,
+        'output': os.path.basename(options.file_name),
+        'epoch': util.build_epoch(),
+    }
+
+
+def digest(manifest):
+    return util.hash_blob(json.dumps(manifest, sort_keys=True), ROUTINE)
+
+
+def find_memoized(cache_dir, digest_of, full_fn):
+    cached_fn = os.path.join(cache_dir, digest_of,
+                             os.path.basename(full_fn))
+    if not os.path.exists(cached_fn):
+        return False
+    print("Found a previous output with the same build manifest %s at %s."
+          % (util.quote(digest_of), util.quote(cached_fn)))
+    if os.path.isdir(cached_fn):
+        shutil.copytree(cached_fn, full_fn, symlinks=True)
+    else:
+        shutil.copy2(cached_fn, full_fn)
+    return True
+
+
+def memoize(cache_dir, digest_of, full_fn):
+    entry_dir = os.path.join(cache_dir, digest_of)
+    if os.path.exists(entry_dir):
+        return
+    print("Storing the output for build manifest %s in %s." %
+          (util.quote(digest_of), util.quote(cache_dir)))
+    # Copy then rename so that a partial copy is never found
+    tmp_dir = "%s.%s.tmp" % (entry_dir, os.getpid())
+    util.ensure_dir(tmp_dir)
+    cached_fn = os.path.join(tmp_dir, os.path.basename(full_fn))
+    if os.path.isdir(full_fn):
+        shutil.copytree(full_fn, cached_fn, symlinks=True)
+    else:
+        shutil.copy2(full_fn, cached_fn)
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # Someone else stored the same output first
+        util.del_dir(tmp_dir)
@@ -13,3 +13,138 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
+
+import pkgutil
+import sys
+
+# External packages can provide modules by registering them as
+# entry points in this group (the entry point name is the module name)
+ENTRY_POINT_GROUP = 'image_builder.modules'
+
+
+def canonical_name(name):
+    return name.strip().replace('-', '_')
+
+
+def _check(value, spec):
+    # A spec is a type (or tuple of types) or a list with one
+    # spec inside of it, meaning a list of values of that spec
+    if isinstance(spec, list):
+        if not isinstance(value, list):
+            return False
+        return all(_check(v, spec[0]) for v in value)
+    return isinstance(value, spec)
+
+
+def _describe(spec):
+    if isinstance(spec, list):
+        return "a list of %s" % (_describe(spec[0]))
+    if isinstance(spec, tuple):
+        return " or ".join(t.__name__ for t in spec)
+    return spec.__name__
+
+
+def _entry_points():
+    # Importing pkg_resources scans every installed distribution, so this
+    # is only done when a module is not one of ours
+    try:
+        import pkg_resources
+    except ImportError:
+        return {}
+    found = {}
+    for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP):
+        found[canonical_name(entry_point.name)] = entry_point
+    return found
+
+
+def _load_entry_point(entry_point):
+    import pkg_resources
+    try:
+        return entry_point.load()
+    except pkg_resources.ResolutionError as e:
+        # Its distribution (or what that requires) is not installed
+        raise ImportError(str(e))
+
+
+class ModuleRegistry(object):
+    def __init__(self):
+        self._found = None
+        self._external = None
+        self._loaded = {}
+
+    def discover(self, external=False):
+        # Finds what modules exist without importing them (done once), the
+        # modules of other packages are only looked for when asked for
+        if self._found is None:
+            found = {}
+            for (_importer, name, _ispkg) in pkgutil.iter_modules(__path__):
+                found[name] = "%s.%s" % (__name__, name)
+            self._found = found
+        if not external:
+            return self._found
+        if self._external is None:
+            self._external = _entry_points()
+        found = dict(self._external)
+        found.update(self._found)
+        return found
+
+    def find(self, name):
+        name = canonical_name(name)
+        if name in self.discover():
+            return self.discover()[name]
+        return self.discover(external=True).get(name)
+
+    def names(self):
+        return sorted(self.discover(external=True).keys())
+
+    def get(self, name):
+        name = canonical_name(name)
+        if name in self._loaded:
+            return self._loaded[name]
+        where = self.find(name)
+        if where is None:
+            raise KeyError("Unknown module %r" % (name))
+        if isinstance(where, basestring):
+            __import__(where)
+            mod = sys.modules[where]
+        else:
+            mod = _load_entry_point(where)
+        self._loaded[name] = mod
+        return mod
+
+    def validate(self, config):
+        # Returns a list of problems with the modules (and their config)
+        # that the given config asks for, before anything is ran...
+        errors = []
+        mods = config.get('modules') or []
+        if not isinstance(mods, list):
+            return ["Config 'modules' must be a list of module names"]
+        for real_name in mods:
+            if not isinstance(real_name, basestring):
+                errors.append("Module name %r is not a string" % (real_name))
+                continue
+            name = canonical_name(real_name)
+            if not name:
+                continue
+            if self.find(name) is None:
+                errors.append("Unknown module %r (known modules are %s)"
+                              % (real_name, ", ".join(self.names())))
+                continue
+            try:
+                mod = self.get(name)
+            except (ImportError, SyntaxError, AttributeError) as e:
+                errors.append("Module %r failed loading: %s" % (real_name, e))
+                continue
+            if not callable(getattr(mod, 'modify', None)):
+                errors.append("Module %r has no modify function"
+                              % (real_name))
+            schema = getattr(mod, 'CONFIG_SCHEMA', None) or {}
+            for (key, spec) in sorted(schema.items()):
+                value = config.get(key)
+                if value is not None and not _check(value, spec):
+                    errors.append("Config %r of module %r must be %s"
+                                  % (key, real_name, _describe(spec)))
+        return errors
+
+
+REGISTRY = ModuleRegistry()
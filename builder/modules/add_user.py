@@ -19,6 +19,10 @@ import os
 
 from builder import util
 
+CONFIG_SCHEMA = {
+    'add_users': [(basestring, int)],
+}
+
 
 def modify(name, root, cfg):
     user_names = cfg.get('add_users')
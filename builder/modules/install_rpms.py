@@ -20,6 +20,10 @@ import os
 
 from builder import util
 
+CONFIG_SCHEMA = {
+    'rpms': [basestring],
+}
+
 
 def expand_rpms(potential_rpms):
     if not potential_rpms:
@@ -37,6 +41,10 @@ def expand_rpms(potential_rpms):
     return rpms_expanded
 
 
+def inputs(name, cfg):
+    return expand_rpms(cfg.get('rpms')) or []
+
+
 def modify(name, root, cfg):
     rpms = expand_rpms(cfg.get('rpms'))
     if not rpms:
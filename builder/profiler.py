@@ -0,0 +1,257 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# Profiles the modules ran on an image: the python side of each module with
+# cProfile and the commands it runs (yum, useradd...) by putting them into a
+# cgroup (v2) of their own, or when that can't be done by the rusage of the
+# finished children.
+
+from __future__ import print_function
+
+import cProfile
+import json
+import os
+import re
+import resource
+import time
+
+from builder import util
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+CGROUP_CONTROLLERS = ['cpu', 'memory', 'io']
+
+
+def cgroup_name(name):
+    return re.sub(r"[^A-Za-z0-9_.-]", '_', name)
+
+
+def _read_keyed(path):
+    # Reads 'key value' lines (like cpu.stat)
+    values = {}
+    for line in util.load_file(path).splitlines():
+        pieces = line.split()
+        if len(pieces) == 2:
+            values[pieces[0]] = int(pieces[1])
+    return values
+
+
+def _read_io(path):
+    # Sums up the 'MAJ:MIN rbytes=N wbytes=N ...' lines of io.stat
+    totals = {'rbytes': 0, 'wbytes': 0}
+    for line in util.load_file(path).splitlines():
+        for piece in line.split()[1:]:
+            (key, _sep, value) = piece.partition('=')
+            if key in totals:
+                totals[key] += int(value)
+    return totals
+
+
+class Cgroup(object):
+    def __init__(self, root, name):
+        self.base = os.path.join(root, 'image-builder-%s' % (os.getpid()))
+        self.path = os.path.join(self.base, cgroup_name(name))
+        self.procs_fn = os.path.join(self.path, 'cgroup.procs')
+
+    def create(self, root):
+        if not os.path.isdir(self.base):
+            os.mkdir(self.base)
+            available = util.load_file(os.path.join(root,
+                                                    'cgroup.controllers'))
+            wanted = [c for c in CGROUP_CONTROLLERS
+                      if c in available.split()]
+            try:
+                with open(os.path.join(self.base, 'cgroup.subtree_control'),
+                          'wb') as fh:
+                    fh.write(" ".join("+%s" % (c) for c in wanted))
+            except (IOError, OSError):
+                # Still get whatever accounting is always there
+                pass
+        os.mkdir(self.path)
+
+    def join(self):
+        # Ran in the forked child (before the command is executed)
+        try:
+            with open(self.procs_fn, 'wb') as fh:
+                fh.write(str(os.getpid()))
+        except (IOError, OSError):
+            pass
+
+    def usage(self):
+        cpu = _read_keyed(os.path.join(self.path, 'cpu.stat'))
+        usage = {
+            'source': 'cgroup',
+            'cpu_user': cpu.get('user_usec', 0) / 1000000.0,
+            'cpu_system': cpu.get('system_usec', 0) / 1000000.0,
+            'memory_peak': None,
+            'io_read': None,
+            'io_write': None,
+        }
+        peak_fn = os.path.join(self.path, 'memory.peak')
+        if os.path.isfile(peak_fn):
+            usage['memory_peak'] = int(util.load_file(peak_fn).strip())
+        io_fn = os.path.join(self.path, 'io.stat')
+        if os.path.isfile(io_fn):
+            io = _read_io(io_fn)
+            usage['io_read'] = io['rbytes']
+            usage['io_write'] = io['wbytes']
+        return usage
+
+    def remove(self):
+        # Anything the module left running keeps it around
+        for path in [self.path, self.base]:
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+
+
+def _children_usage():
+    return resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+def _rusage_delta(before, after):
+    return {
+        'source': 'rusage',
+        'cpu_user': after.ru_utime - before.ru_utime,
+        'cpu_system': after.ru_stime - before.ru_stime,
+        # This is the largest of any child so far (not just of this module)
+        'memory_peak': after.ru_maxrss * 1024,
+        'io_read': (after.ru_inblock - before.ru_inblock) * 512,
+        'io_write': (after.ru_oublock - before.ru_oublock) * 512,
+    }
+
+
+class _Runner(object):
+    # Times (and accounts for) the commands a module runs via util.subp
+    def __init__(self, profiler, name, runner, cgroup):
+        self.profiler = profiler
+        self.name = name
+        self.runner = runner
+        self.cgroup = cgroup
+
+    def __call__(self, args, data=None, env=None, capture=True, shell=False):
+        started = time.time()
+        if self.cgroup and self.runner is util.spawn:
+            result = util.spawn(args, data=data, env=env, capture=capture,
+                                shell=shell, preexec_fn=self.cgroup.join)
+        else:
+            result = self.runner(args, data=data, env=env,
+                                 capture=capture, shell=shell)
+        self.profiler.commands.append({
+            'module': self.name,
+            'args': [str(a) for a in args],
+            'rc': result[0],
+            'elapsed': time.time() - started,
+        })
+        return result
+
+
+class ModuleProfiler(object):
+    def __init__(self, cgroup_root=CGROUP_ROOT):
+        self.cgroup_root = cgroup_root
+        self.modules = []
+        self.commands = []
+        self.profiles = {}
+
+    def _cgroup(self, name):
+        # Commands only end up in it when they are really ran (and not
+        # recorded or replayed)
+        if util.get_subp_runner() is not util.spawn:
+            return None
+        if not os.path.isfile(os.path.join(self.cgroup_root,
+                                           'cgroup.controllers')):
+            return None
+        cgroup = Cgroup(self.cgroup_root, name)
+        try:
+            cgroup.create(self.cgroup_root)
+        except (IOError, OSError) as e:
+            print("Unable to create a cgroup for module %r (%s), using"
+                  " the rusage of its commands instead." % (name, e))
+            cgroup.remove()
+            return None
+        return cgroup
+
+    def call(self, name, functor, *args):
+        cgroup = self._cgroup(name)
+        before = _children_usage()
+        prof = cProfile.Profile()
+        runner = _Runner(self, name, util.get_subp_runner(), cgroup)
+        old_runner = util.set_subp_runner(runner)
+        started = time.time()
+        failed = True
+        try:
+            result = prof.runcall(functor, *args)
+            failed = False
+            return result
+        finally:
+            elapsed = time.time() - started
+            util.set_subp_runner(old_runner)
+            usage = None
+            if cgroup:
+                try:
+                    usage = cgroup.usage()
+                except (IOError, OSError, ValueError):
+                    pass
+                cgroup.remove()
+            if not usage:
+                usage = _rusage_delta(before, _children_usage())
+            self.profiles[name] = prof
+            details = {
+                'module': name,
+                'elapsed': elapsed,
+                'failed': failed,
+                'commands': len([c for c in self.commands
+                                 if c['module'] == name]),
+            }
+            details.update(usage)
+            self.modules.append(details)
+
+    def save(self, out_dir):
+        util.ensure_dir(out_dir)
+        for (name, prof) in self.profiles.items():
+            prof.dump_stats(os.path.join(out_dir, 'profile-%s.prof'
+                                         % (cgroup_name(name))))
+        util.write_file(os.path.join(out_dir, 'profile.json'),
+                        json.dumps({'modules': self.modules,
+                                    'commands': self.commands},
+                                   sort_keys=True, indent=4))
+
+    def report(self, top=5):
+        slowest = sorted(self.modules, key=lambda m: m['elapsed'],
+                         reverse=True)[0:top]
+        lines = []
+        for mod in slowest:
+            line = ("%s took %.2f seconds (%.2f user, %.2f system cpu"
+                    " seconds by its %s commands)" % (mod['module'],
+                                                      mod['elapsed'],
+                                                      mod['cpu_user'],
+                                                      mod['cpu_system'],
+                                                      mod['commands']))
+            if mod['memory_peak'] is not None:
+                line += ", %s peak memory bytes" % (mod['memory_peak'])
+            if mod['io_read'] is not None:
+                line += ", %s/%s bytes read/written" % (mod['io_read'],
+                                                        mod['io_write'])
+            lines.append(line)
+        util.print_iterable(lines, header="Slowest %s modules" % (len(lines)))
+        slowest = sorted(self.commands, key=lambda c: c['elapsed'],
+                         reverse=True)[0:top]
+        lines = []
+        for cmd in slowest:
+            lines.append("%s took %.2f seconds (in module %s)"
+                         % (cmd['args'], cmd['elapsed'], cmd['module']))
+        header = "Slowest %s module commands" % (len(lines))
+        util.print_iterable(lines, header=header)
@@ -0,0 +1,215 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# Records every command ran through util.subp (with its timing and output)
+# during a real build so that the build can later be replayed without root
+# (and without the privileged tools) to benchmark the build pipeline itself.
+#
+# A recording is a file of json lines, one per command ran.
+
+from __future__ import print_function
+
+import json
+import os
+import re
+import time
+
+from builder import util
+
+# Parts of paths that differ between builds (temporary dirs and files)
+TEMP_NAME = re.compile(r"^(tmp|builder-)[A-Za-z0-9_]{6}(\.raw)?$")
+
+# Loop devices also differ between builds
+LOOP_DEV = re.compile(r"^/dev/loop[0-9]+$")
+
+# Directories (relative to a mount point) whose listing is recorded when
+# something is mounted, so that the build finds the same files when replayed
+SNAPSHOT_DIRS = ['boot']
+
+
+def normalize(args):
+    normalized = []
+    for arg in args:
+        arg = str(arg)
+        if LOOP_DEV.match(arg):
+            normalized.append('/dev/loop*')
+            continue
+        pieces = []
+        for piece in arg.split(os.sep):
+            if TEMP_NAME.match(piece):
+                piece = '*'
+            pieces.append(piece)
+        normalized.append(os.sep.join(pieces))
+    return json.dumps(normalized)
+
+
+def _arg_path(arg):
+    # Commands like dd take paths as key=value arguments
+    arg = str(arg)
+    if '=' in arg and not arg.startswith(os.sep):
+        arg = arg.split('=', 1)[1]
+    if arg.startswith(os.sep):
+        return arg
+    return None
+
+
+def _encode(output):
+    # Command output is bytes (that need not be utf-8), which json only
+    # keeps as is when each byte is stored as the same code point
+    if output is None:
+        return None
+    return output.decode('latin-1')
+
+
+def _decode(output):
+    if output is None:
+        return None
+    return output.encode('latin-1')
+
+
+def _mount_target(args):
+    if args and os.path.basename(str(args[0])) == 'mount' and len(args) > 2:
+        return str(args[-1])
+    return None
+
+
+class Recorder(object):
+    def __init__(self, path, runner=util.spawn):
+        self.path = path
+        self.runner = runner
+        self.start = time.time()
+        util.write_file(self.path, '')
+
+    def __call__(self, args, data=None, env=None, capture=True, shell=False):
+        before = {}
+        for (i, arg) in enumerate(args):
+            path = _arg_path(arg)
+            if path and os.path.isfile(path):
+                before[i] = os.path.getsize(path)
+        started = time.time()
+        (rc, out, err) = self.runner(args, data=data, env=env,
+                                     capture=capture, shell=shell)
+        elapsed = time.time() - started
+        # Remember the sizes of the files the command made (or resized)
+        outputs = {}
+        for (i, arg) in enumerate(args):
+            path = _arg_path(arg)
+            if not path or not os.path.isfile(path):
+                continue
+            size = os.path.getsize(path)
+            if before.get(i) != size:
+                outputs[str(i)] = size
+        snapshot = {}
+        target = _mount_target(args)
+        if target and rc == 0:
+            for snap_dir in SNAPSHOT_DIRS:
+                full_dir = os.path.join(target, snap_dir)
+                if os.path.isdir(full_dir):
+                    snapshot[snap_dir] = sorted(os.listdir(full_dir))
+        record = {
+            'args': [str(a) for a in args],
+            'key': normalize(args),
+            'rc': rc,
+            'stdout': _encode(out),
+            'stderr': _encode(err),
+            'capture': capture,
+            'offset': started - self.start,
+            'elapsed': elapsed,
+            'outputs': outputs,
+            'snapshot': snapshot,
+        }
+        with open(self.path, 'ab') as fh:
+            fh.write("%s\n" % (json.dumps(record)))
+        return (rc, out, err)
+
+
+class Replayer(object):
+    def __init__(self, path, speed=1.0):
+        self.speed = speed
+        self.records = {}
+        self.delays = {}
+        self.replayed = 0
+        self.simulated = 0
+        self.recorded_time = 0.0
+        self.start = time.time()
+        with open(path, 'rb') as fh:
+            for line in fh:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                self.records.setdefault(record['key'], []).append(record)
+                prog = os.path.basename(record['args'][0])
+                self.delays.setdefault(prog, []).append(record['elapsed'])
+
+    def _simulate(self, args):
+        # Nothing recorded for this command, so pretend it worked and
+        # took as long as the same program usually took...
+        prog = os.path.basename(str(args[0]))
+        delays = sorted(self.delays.get(prog) or [0.0])
+        return {
+            'rc': 0,
+            'stdout': '',
+            'stderr': '',
+            'elapsed': delays[len(delays) // 2],
+            'outputs': {},
+            'snapshot': {},
+        }
+
+    def __call__(self, args, data=None, env=None, capture=True, shell=False):
+        matches = self.records.get(normalize(args))
+        if matches:
+            record = matches.pop(0)
+            self.replayed += 1
+        else:
+            print("No recording of %s, simulating it." % (args))
+            record = self._simulate(args)
+            self.simulated += 1
+        self.recorded_time += record['elapsed']
+        if self.speed > 0:
+            time.sleep(record['elapsed'] / self.speed)
+        # Recreate (sparse) files the command made, and the files that
+        # were found when something was mounted.
+        for (i, size) in record['outputs'].items():
+            path = _arg_path(args[int(i)])
+            if not path:
+                continue
+            util.ensure_file(path)
+            if os.path.getsize(path) != size:
+                with open(path, 'r+b') as fh:
+                    fh.truncate(size)
+        target = _mount_target(args)
+        if target:
+            for (snap_dir, names) in record['snapshot'].items():
+                full_dir = os.path.join(target, snap_dir)
+                util.ensure_dir(full_dir)
+                for name in names:
+                    util.ensure_file(os.path.join(full_dir, name))
+        out = _decode(record['stdout'])
+        err = _decode(record['stderr'])
+        if not capture:
+            out = None
+            err = None
+        return (record['rc'], out, err)
+
+    def report(self):
+        elapsed = time.time() - self.start
+        left = sum(len(r) for r in self.records.values())
+        print(("Replayed %s commands (%s simulated, %s recorded ones unused)"
+               " in %.2f seconds, the commands took %.2f seconds when"
+               " recorded.") % (self.replayed + self.simulated,
+                                self.simulated, left, elapsed,
+                                self.recorded_time))
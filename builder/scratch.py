@@ -0,0 +1,104 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from __future__ import print_function
+
+import contextlib
+import os
+import tempfile
+
+from builder import loopdev
+from builder import util
+
+# Where the scratch files can be placed, the memory backed modes
+# mount a tmpfs (optionally using transparent huge pages) to hold them.
+MODES = ['disk', 'tmpfs', 'hugepages']
+
+
+def mem_available():
+    info = {}
+    contents = util.load_file('/proc/meminfo', quiet=True) or ''
+    for line in contents.splitlines():
+        pieces = line.split()
+        if len(pieces) >= 2:
+            try:
+                info[pieces[0].rstrip(':')] = int(pieces[1]) * 1024
+            except ValueError:
+                pass
+    if 'MemAvailable' in info:
+        return info['MemAvailable']
+    # Older kernels don't provide an estimate, so make our own...
+    return (info.get('MemFree', 0) + info.get('Buffers', 0) +
+            info.get('Cached', 0))
+
+
+def disk_free(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def estimate_peak(image_size, strip_partition):
+    # The scratch raw image, the converted image and (when stripping the
+    # partition table) a second raw copy can all exist at the same time.
+    peak = image_size * 2
+    if strip_partition:
+        peak += image_size
+    return peak
+
+
+def pick_mode(root, mode, needed, reserve):
+    if mode != 'disk':
+        avail = mem_available()
+        if needed + reserve > avail:
+            print(("Scratch space needs %s bytes (plus %s reserved) but only"
+                   " %s bytes of memory are available, falling back to"
+                   " using the disk.") % (needed, reserve, avail))
+            mode = 'disk'
+    if mode == 'disk':
+        # The images are sparse, so this is only a worst case on disk
+        free = disk_free(root)
+        if needed > free:
+            print(("Scratch space could need up to %s bytes but only %s"
+                   " bytes are free in %s, continuing anyway.")
+                  % (needed, free, util.quote(root)))
+    return mode
+
+
+@contextlib.contextmanager
+def workspace(loops, root=None, mode='disk', needed=0, reserve=0):
+    if not root:
+        root = tempfile.gettempdir()
+    util.ensure_dir(root)
+    mode = pick_mode(root, mode, needed, reserve)
+    old_tempdir = tempfile.tempdir
+    with util.tempdir(dir=root, prefix='builder-') as tdir:
+        print("Using %s scratch space in %s." % (util.quote(mode),
+                                                 util.quote(tdir)))
+        if mode != 'disk':
+            options = ['size=%s' % (needed), 'mode=0700']
+            if mode == 'hugepages':
+                options.append('huge=always')
+            loops.mount('tmpfs', tdir, fs_type='tmpfs', options=options)
+        # All the temporary files (and dirs) now default to going here
+        tempfile.tempdir = tdir
+        failed = True
+        try:
+            yield tdir
+            failed = False
+        finally:
+            tempfile.tempdir = old_tempdir
+            if mode != 'disk':
+                loopdev.undo(loops.umount, tdir, failed)
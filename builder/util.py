@@ -14,10 +14,13 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from __future__ import print_function
+
 from StringIO import StringIO
 
 import contextlib
 import errno
+import fcntl
 import hashlib
 import os
 import random
@@ -35,6 +38,9 @@ import yaml
 
 COLORS = termcolor.COLORS.keys()
 
+# From linux/fs.h, makes the target share (reflink) all of the source's data
+FICLONE = 0x40049409
+
 
 class ProcessExecutionError(IOError):
 
@@ -127,11 +133,18 @@ def find_file(name, path):
     return None
 
 
-def download_url(url, where_to, timeout=5):
-    with contextlib.closing(urllib2.urlopen(url, timeout=timeout)) as rh:
+def download_url(url, where_to, timeout=5, offset=0):
+    req = urllib2.Request(url)
+    if offset:
+        # Continue on from what was already downloaded
+        req.add_header('Range', 'bytes=%s-' % (offset))
+    with contextlib.closing(urllib2.urlopen(req, timeout=timeout)) as rh:
         status = rh.getcode()
         if status not in xrange(200, 300):
             raise RuntimeError("Fetch failed due to status %s" % (status))
+        if offset and status != 206:
+            # Server doesn't do ranges, so start over...
+            offset = 0
         headers = rh.headers
         clen = headers.get('Content-Length')
         try:
@@ -146,19 +159,31 @@ def download_url(url, where_to, timeout=5):
                 ' ', progressbar.ETA(),
                 ' ', progressbar.FileTransferSpeed(),
             ]
-            pbar = progressbar.ProgressBar(maxval=clen, widgets=widgets)
+            pbar = progressbar.ProgressBar(maxval=clen + offset,
+                                           widgets=widgets)
             pbar.start()
 
         def call_cb(byte_down, _chunk):
             if pbar:
-                pbar.update(byte_down)
+                pbar.update(offset + byte_down)
 
         try:
-            with open(where_to, 'w') as wh:
-                pipe_in_out(rh, wh, chunk_cb=call_cb)
+            if offset:
+                omode = 'ab'
+            else:
+                omode = 'wb'
+            with open(where_to, omode) as wh:
+                if offset:
+                    wh.truncate(offset)
+                byte_am = pipe_in_out(rh, wh, chunk_size=65536,
+                                      chunk_cb=call_cb)
         finally:
             if pbar:
                 pbar.finish()
+        if clen > 0 and byte_am < clen:
+            raise IOError("Fetch of %s ended after %s of %s bytes"
+                          % (url, byte_am, clen))
+    return offset + byte_am
 
 
 def pretty_transfer(in_fh, out_fh, quiet=False, 
@@ -246,6 +271,18 @@ def pipe_in_out(in_fh, out_fh, chunk_size=1024, chunk_cb=None):
     return bytes_piped
 
 
+class HashWriter(object):
+    # File like object that just feeds what is written into a hasher
+    def __init__(self, hasher):
+        self.hasher = hasher
+
+    def write(self, data):
+        self.hasher.update(data)
+
+    def flush(self):
+        pass
+
+
 def print_iterable(to_log, header=None, do_color=True):
     if not to_log:
         return
@@ -265,6 +302,13 @@ def hash_blob(blob, routine):
     return hasher.hexdigest()
 
 
+def hash_file(path, routine, chunk_size=1024 * 1024):
+    hasher = hashlib.new(routine)
+    with open(path, 'rb') as fh:
+        pipe_in_out(fh, HashWriter(hasher), chunk_size=chunk_size)
+    return hasher.hexdigest()
+
+
 def ensure_dirs(dirlist, mode=0755):
     for d in dirlist:
         ensure_dir(d, mode)
@@ -291,12 +335,67 @@ def del_file(path):
 
 
 def copy(src, dest):
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(src))
+    # Try to share the data blocks first (on filesystems that support
+    # reflinks this is near instant), otherwise just copy the data...
+    try:
+        with open(src, 'rb') as in_fh:
+            with open(dest, 'wb') as out_fh:
+                fcntl.ioctl(out_fh.fileno(), FICLONE, in_fh.fileno())
+        shutil.copymode(src, dest)
+        return
+    except (IOError, OSError):
+        pass
     shutil.copy(src, dest)
 
 
-def time_rfc2822():
+def copy_tree(src, dest):
+    # Copies the contents of src into dest using one 'cp' (so hardlinks
+    # anywhere in the tree stay hardlinks) that reflinks when it can.
+    subp(['cp', '-a', '--reflink=auto', os.path.join(src, '.'), dest],
+         capture=False)
+
+
+def parse_size(text):
+    # Converts sizes like '512', '4K', '1M' or '2G' into bytes
+    text = str(text).strip()
+    multipliers = {
+        'k': 1024,
+        'm': 1024 ** 2,
+        'g': 1024 ** 3,
+        't': 1024 ** 4,
+    }
+    multiplier = 1
+    if text and text[-1].lower() in multipliers:
+        multiplier = multipliers[text[-1].lower()]
+        text = text[0:-1]
+    return int(float(text) * multiplier)
+
+
+def allocated_size(path):
+    # How many bytes are actually allocated on disk (sparse files
+    # will have less allocated than their apparent size)
+    return os.stat(path).st_blocks * 512
+
+
+def used_space(path):
+    # How many bytes are in use on the filesystem that path is on
+    st = os.statvfs(path)
+    return (st.f_blocks - st.f_bfree) * st.f_frsize
+
+
+def build_epoch():
+    # See: https://reproducible-builds.org/specs/source-date-epoch/
+    epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    if not epoch:
+        return None
+    return int(epoch)
+
+
+def time_rfc2822(when=None):
     try:
-        ts = time.strftime("%a, %d %b %Y %H:%M:%S %z", time.gmtime())
+        ts = time.strftime("%a, %d %b %Y %H:%M:%S %z", time.gmtime(when))
     except:
         ts = "??"
     return ts
@@ -324,12 +423,10 @@ def write_file(filename, content, mode=0644, omode="wb"):
     chmod(filename, mode)
 
 
-def subp(args, data=None, rcs=None, env=None, capture=True, shell=False):
-    if rcs is None:
-        rcs = [0]
+def spawn(args, data=None, env=None, capture=True, shell=False,
+          preexec_fn=None):
+    # Actually runs the command, returning its (rc, stdout, stderr)
     try:
-        print(("++ Running command %s with allowed return codes %s"
-               " (shell=%s, capture=%s)") % (args, rcs, shell, capture))
         if not capture:
             stdout = None
             stderr = None
@@ -339,11 +436,37 @@ def subp(args, data=None, rcs=None, env=None, capture=True, shell=False):
         stdin = subprocess.PIPE
         sp = subprocess.Popen(args, stdout=stdout,
                         stderr=stderr, stdin=stdin,
-                        env=env, shell=shell)
+                        env=env, shell=shell, preexec_fn=preexec_fn)
         (out, err) = sp.communicate(data)
     except OSError as e:
         raise ProcessExecutionError(cmd=args, reason=e)
-    rc = sp.returncode
+    return (sp.returncode, out, err)
+
+
+# What subp uses to run commands (see set_subp_runner)
+SUBP_RUNNER = {'runner': spawn}
+
+
+def get_subp_runner():
+    return SUBP_RUNNER['runner']
+
+
+def set_subp_runner(runner):
+    # Replaces what subp uses to run commands (see builder.replay), the
+    # runner has the same arguments and return value as spawn, returns
+    # the previous runner so that it can be restored (or called).
+    old_runner = SUBP_RUNNER['runner']
+    SUBP_RUNNER['runner'] = runner
+    return old_runner
+
+
+def subp(args, data=None, rcs=None, env=None, capture=True, shell=False):
+    if rcs is None:
+        rcs = [0]
+    print(("++ Running command %s with allowed return codes %s"
+           " (shell=%s, capture=%s)") % (args, rcs, shell, capture))
+    (rc, out, err) = get_subp_runner()(args, data=data, env=env,
+                                       capture=capture, shell=shell)
     if rc not in rcs:
         raise ProcessExecutionError(stdout=out, stderr=err,
                                     exit_code=rc,
@@ -2,7 +2,7 @@
 
 function find_src {
   files=`find builder -type f | grep "py\$"`
-  echo "build.py $files"
+  echo "build.py buildd.py $files"
 }
 
 function run_pylint {
@@ -0,0 +1,97 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from builder import initrd
+from builder import util
+
+
+class FakeMkinitrd(object):
+    # Stands in for running mkinitrd in the image (see util.set_subp_runner)
+    def __init__(self):
+        self.ran = []
+
+    def __call__(self, args, data=None, env=None, capture=True, shell=False):
+        self.ran.append(list(args))
+        (root_dir, kid) = (args[1], args[-1])
+        util.write_file(os.path.join(root_dir, 'boot',
+                                     'initramfs-%s.img' % (kid)), 'rd')
+        return (0, '', '')
+
+
+class TestHarvestBoot(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.mkinitrd = FakeMkinitrd()
+        self.old_runner = util.set_subp_runner(self.mkinitrd)
+
+    def tearDown(self):
+        util.set_subp_runner(self.old_runner)
+        shutil.rmtree(self.tmp_dir)
+
+    def make_root(self, name, boot_fns):
+        root_dir = os.path.join(self.tmp_dir, name)
+        for fn in boot_fns:
+            util.write_file(os.path.join(root_dir, 'boot', fn), fn)
+        util.write_file(os.path.join(root_dir, 'lib', 'modules', '2.6.32',
+                                     'modules.dep'), 'deps')
+        return root_dir
+
+    def test_kernel_without_initramfs(self):
+        # Only a base initrd, so the initramfs is made (and cached)
+        root_dir = self.make_root('first', ['vmlinuz-2.6.32',
+                                            'initrd-2.6.32.img'])
+        img_dir = os.path.join(self.tmp_dir, 'img-first')
+        boot_fns = initrd.harvest_boot(root_dir, img_dir, self.cache_dir)
+        self.assertEqual(('vmlinuz-2.6.32', 'initramfs-2.6.32.img'),
+                         boot_fns)
+        self.assertEqual(1, len(self.mkinitrd.ran))
+        self.assertEqual(['chroot', root_dir, '/sbin/mkinitrd', '-f',
+                          '/boot/initrd-2.6.32.img', '2.6.32'],
+                         self.mkinitrd.ran[0])
+        self.assertEqual(sorted(boot_fns), sorted(os.listdir(img_dir)))
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+
+        # The same kernel (and modules) again uses the cached one
+        root_dir = self.make_root('second', ['vmlinuz-2.6.32',
+                                             'initrd-2.6.32.img'])
+        img_dir = os.path.join(self.tmp_dir, 'img-second')
+        boot_fns = initrd.harvest_boot(root_dir, img_dir, self.cache_dir)
+        self.assertEqual(('vmlinuz-2.6.32', 'initramfs-2.6.32.img'),
+                         boot_fns)
+        self.assertEqual(1, len(self.mkinitrd.ran))
+        self.assertEqual('rd', util.load_file(
+            os.path.join(img_dir, 'initramfs-2.6.32.img')))
+
+    def test_existing_initramfs(self):
+        root_dir = self.make_root('existing', ['vmlinuz-2.6.32',
+                                               'initramfs-2.6.32.img',
+                                               'initrd-2.6.32.img'])
+        img_dir = os.path.join(self.tmp_dir, 'img')
+        boot_fns = initrd.harvest_boot(root_dir, img_dir, self.cache_dir)
+        self.assertEqual(('vmlinuz-2.6.32', 'initramfs-2.6.32.img'),
+                         boot_fns)
+        self.assertEqual([], self.mkinitrd.ran)
+
+    def test_no_kernel(self):
+        root_dir = self.make_root('nokernel', ['initramfs-2.6.32.img'])
+        self.assertRaises(RuntimeError, initrd.harvest_boot, root_dir,
+                          os.path.join(self.tmp_dir, 'img'))
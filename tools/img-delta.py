@@ -0,0 +1,82 @@
+#!/usr/bin/python
+
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# Applies and verifies the chunk deltas made by 'build.py --delta-format chunks'
+#
+# Usage:
+#   img-delta.py apply BASE DELTA OUTPUT.raw
+#   img-delta.py verify IMAGE.raw MANIFEST
+#   img-delta.py manifest IMAGE.raw MANIFEST
+
+import optparse
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir)))
+
+from builder import delta
+from builder import util
+
+
+def to_raw(path, tdir):
+    # Deltas are made against the raw image, so convert anything else
+    if path.endswith('.raw'):
+        return path
+    raw_fn = os.path.join(tdir, 'base.raw')
+    util.subp(['qemu-img', 'convert', '-O', 'raw', path, raw_fn],
+              capture=False)
+    return raw_fn
+
+
+def main():
+    parser = optparse.OptionParser(usage=("%prog apply BASE DELTA OUTPUT |"
+                                          " verify IMAGE MANIFEST |"
+                                          " manifest IMAGE MANIFEST"))
+    (_options, args) = parser.parse_args()
+    if len(args) < 1:
+        parser.error("An action is required")
+    action = args[0]
+    if action == 'apply' and len(args) == 4:
+        (base_fn, delta_fn, out_fn) = args[1:]
+        with util.tempdir() as tdir:
+            print("Applying %s to %s." % (util.quote(delta_fn),
+                                          util.quote(base_fn)))
+            delta.apply_delta(to_raw(base_fn, tdir), delta_fn, out_fn)
+        print("Wrote and verified %s." % (util.quote(out_fn)))
+    elif action == 'verify' and len(args) == 3:
+        (img_fn, manifest_fn) = args[1:]
+        bad = delta.verify(img_fn, delta.load_manifest(manifest_fn))
+        if bad:
+            print("%s chunks of %s do not match %s." %
+                  (util.quote(len(bad), quote_color='red'),
+                   util.quote(img_fn), util.quote(manifest_fn)))
+            return 1
+        print("%s matches %s." % (util.quote(img_fn),
+                                  util.quote(manifest_fn)))
+    elif action == 'manifest' and len(args) == 3:
+        (img_fn, manifest_fn) = args[1:]
+        delta.write_manifest(delta.make_manifest(img_fn), manifest_fn)
+        print("Wrote %s." % (util.quote(manifest_fn)))
+    else:
+        parser.error("Unknown action or wrong arguments")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())